@@ -26,6 +26,13 @@ SOURCE_FILESYSTEM = "/run/initramfs/live/LiveOS/squashfs.img"
 # The guy inside that is actually our filesystem to copy
 INNER_FILESYSTEM = "LiveOS/rootfs.img"
 
+# Optional build-time sha256sum list for the files within INNER_FILESYSTEM
+SOURCE_DIGESTS = "/run/initramfs/live/LiveOS/rootfs.sha256sums"
+
+# Optional build-time list of extra globs within INNER_FILESYSTEM to leave
+# off the installed system, one per line
+SOURCE_EXCLUDES = "/run/initramfs/live/LiveOS/rootfs.excludes"
+
 # Absolute minimum size
 MB = 1000 * 1000
 GB = 1000 * MB
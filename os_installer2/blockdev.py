@@ -0,0 +1,248 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from collections import OrderedDict
+import os
+import re
+
+SYSFS_BLOCK = "/sys/class/block"
+SYSFS_DEVNO = "/sys/dev/block"
+
+# sysfs always reports sizes in 512 byte sectors, whatever the device uses
+SYSFS_SECTOR_SIZE = 512
+
+# Partitions are aligned to at least this many bytes
+MIN_ALIGNMENT = 1024 * 1024
+
+# Whole disks we can install to, as gparted recognises them: plain named
+# disks (sda, vdb), eMMC, NVMe namespaces and software RAID
+RE_WHOLE_DISK = re.compile(
+    "^([^0-9]+|mmcblk[0-9]+|nvme[0-9]+n[0-9]+|md[0-9]+)$")
+
+
+def read_sysfs(path):
+    """ Return the stripped contents of a sysfs attribute, or None """
+    try:
+        with open(path, "r") as inp:
+            return inp.read().strip()
+    except Exception:
+        return None
+
+
+def read_sysfs_int(path, default=0):
+    """ Return a numeric sysfs attribute, or default """
+    value = read_sysfs(path)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+class BlockDevice:
+    """ Compact snapshot of a whole block device, as sysfs describes it """
+
+    # i.e. sda, and its device node /dev/sda
+    name = None
+    path = None
+
+    # Size in bytes
+    size = 0
+
+    read_only = False
+    removable = False
+    rotational = True
+
+    # As reported by the device, may be None
+    model = None
+    vendor = None
+
+    # Block sizes and preferred I/O size, in bytes (0 if not reported)
+    logical_block_size = SYSFS_SECTOR_SIZE
+    physical_block_size = SYSFS_SECTOR_SIZE
+    optimal_io_size = 0
+
+    # Whether the device accepts discards, i.e. TRIM
+    discard = False
+
+    def __init__(self, name, root=SYSFS_BLOCK):
+        self.name = name
+        self.path = "/dev/{}".format(name)
+
+        base = os.path.join(root, name)
+        queue = os.path.join(base, "queue")
+        self.size = read_sysfs_int(os.path.join(base, "size")) * \
+            SYSFS_SECTOR_SIZE
+        self.read_only = read_sysfs_int(os.path.join(base, "ro")) == 1
+        self.removable = read_sysfs_int(os.path.join(base, "removable")) == 1
+        self.rotational = read_sysfs_int(
+            os.path.join(queue, "rotational"), 1) == 1
+        self.model = read_sysfs(os.path.join(base, "device", "model"))
+        self.vendor = read_sysfs(os.path.join(base, "device", "vendor"))
+        self.logical_block_size = read_sysfs_int(
+            os.path.join(queue, "logical_block_size"), SYSFS_SECTOR_SIZE)
+        self.physical_block_size = read_sysfs_int(
+            os.path.join(queue, "physical_block_size"), SYSFS_SECTOR_SIZE)
+        self.optimal_io_size = read_sysfs_int(
+            os.path.join(queue, "optimal_io_size"))
+        self.discard = read_sysfs_int(
+            os.path.join(queue, "discard_max_bytes")) > 0
+
+    def is_ssd(self):
+        """ Determine if this is a solid state disk worth trimming """
+        # Don't try using SSD trim with eMMC
+        if self.name.startswith("mmcblk"):
+            return False
+        return not self.rotational
+
+    def get_alignment(self):
+        """ Bytes that partitions on this device should be aligned to """
+        optimal = self.optimal_io_size
+        if optimal > MIN_ALIGNMENT and optimal % MIN_ALIGNMENT == 0:
+            return optimal
+        return MIN_ALIGNMENT
+
+    def is_eligible(self, min_size):
+        """ Determine if we could possibly install to this device """
+        if self.read_only:
+            print("DEBUG: Skipping read-only device: {}".format(self.path))
+            return False
+        if self.size < min_size:
+            print("DEBUG: Skipping tiny drive: {}".format(self.path))
+            return False
+        return True
+
+
+def is_whole_disk(name, root=SYSFS_BLOCK):
+    """ Determine if the named block device is a disk we might install to,
+        rather than a partition or some virtual device """
+    if not RE_WHOLE_DISK.match(name):
+        return False
+    # Partitions live alongside their disks here
+    return not os.path.exists(os.path.join(root, name, "partition"))
+
+
+def get_devno_name(devno, root=SYSFS_DEVNO):
+    """ Name of the block device with the given major:minor, or None """
+    path = os.path.join(root, devno)
+    if not os.path.exists(path):
+        return None
+    return os.path.basename(os.path.realpath(path))
+
+
+def get_backing_devices(name, root=SYSFS_BLOCK):
+    """ Names of every block device the named one lives on: itself, its
+        disk if it is a partition, and whatever it is built from when it
+        is an LVM volume, RAID array or crypt mapping """
+    ret = set()
+    pending = [name]
+    while pending:
+        name = pending.pop()
+        if name in ret:
+            continue
+        ret.add(name)
+        base = os.path.join(root, name)
+        if os.path.exists(os.path.join(base, "partition")):
+            disk = os.path.dirname(os.path.realpath(base))
+            pending.append(os.path.basename(disk))
+        try:
+            pending.extend(os.listdir(os.path.join(base, "slaves")))
+        except OSError:
+            pass
+    return ret
+
+
+def get_queue_device(path, root=SYSFS_BLOCK):
+    """ Snapshot the device whose request queue serves the node at path,
+        which for a partition is its disk, or None """
+    name = os.path.basename(os.path.realpath(path))
+    base = os.path.join(root, name)
+    if os.path.exists(os.path.join(base, "partition")):
+        name = os.path.basename(os.path.dirname(os.path.realpath(base)))
+    if not os.path.exists(os.path.join(root, name)):
+        return None
+    return BlockDevice(name, root)
+
+
+def get_node_size(path, root=SYSFS_BLOCK):
+    """ Size in bytes of any block device node, partitions included """
+    name = os.path.basename(os.path.realpath(path))
+    return read_sysfs_int(os.path.join(root, name, "size")) * \
+        SYSFS_SECTOR_SIZE
+
+
+def get_block_device(path, root=SYSFS_BLOCK):
+    """ Snapshot a single whole device by its node, or None if sysfs has
+        no such device """
+    name = os.path.basename(os.path.realpath(path))
+    if not os.path.exists(os.path.join(root, name)):
+        return None
+    return BlockDevice(name, root)
+
+
+class BlockInventory:
+    """ Every whole disk in the system, from one pass over sysfs """
+
+    root = None
+
+    # Mapping of device node -> BlockDevice, sorted by name
+    devices = None
+
+    def __init__(self, root=SYSFS_BLOCK):
+        self.root = root
+        self.devices = OrderedDict()
+
+    def scan(self):
+        """ Take a fresh snapshot of all whole disks """
+        self.devices = OrderedDict()
+        try:
+            names = sorted(os.listdir(self.root))
+        except Exception as e:
+            print("Failed to scan block devices: {}".format(e))
+            return
+        for name in names:
+            if not is_whole_disk(name, self.root):
+                continue
+            device = BlockDevice(name, self.root)
+            if not os.path.exists(device.path):
+                print("Debug: Non-existent node: {}".format(device.path))
+                continue
+            self.devices[device.path] = device
+
+    def add(self, path):
+        """ Snapshot a single newly attached disk into the inventory,
+            replacing any earlier record of it. Returns the BlockDevice, or
+            None if it isn't a disk we know how to use """
+        self.remove(path)
+        name = os.path.basename(os.path.realpath(path))
+        if not is_whole_disk(name, self.root):
+            return None
+        device = get_block_device(path, self.root)
+        if not device:
+            return None
+        self.devices[device.path] = device
+        self.devices = OrderedDict(sorted(self.devices.items()))
+        return device
+
+    def remove(self, path):
+        """ Forget a disk that has gone away """
+        self.devices.pop(os.path.realpath(path), None)
+
+    def get(self, path):
+        """ Return the BlockDevice for a node, or None """
+        return self.devices.get(os.path.realpath(path))
+
+    def get_eligible(self, min_size):
+        """ Return all devices we could possibly install to """
+        return [x for x in self.devices.values() if x.is_eligible(min_size)]
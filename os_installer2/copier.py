@@ -0,0 +1,1200 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from . import SOURCE_EXCLUDES
+from . import syscalls
+import collections
+import errno
+import fnmatch
+import hashlib
+import math
+import multiprocessing
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Largest single request handed to the kernel
+TRANSFER_CHUNK = 8 * 1024 * 1024
+
+# Buffer size for the userspace fallback loop
+FALLBACK_BUF_SIZE = 1024 * 1024
+
+# st_blocks is always counted in these units
+STAT_BLOCK_SIZE = 512
+
+# Written data per file before we wait for its writeback
+WRITEBACK_CHUNK = 16 * 1024 * 1024
+
+# Finished files per thread whose writeback may still be in flight
+WRITEBACK_DEPTH = 32
+
+# Start writeback of a range and wait for all of it to complete
+SYNC_AND_WAIT = syscalls.SYNC_FILE_RANGE_WAIT_BEFORE | \
+    syscalls.SYNC_FILE_RANGE_WRITE | \
+    syscalls.SYNC_FILE_RANGE_WAIT_AFTER
+
+# Upper bound on copy threads, beyond this we just thrash the disk
+MAX_WORKERS = 8
+
+# Pending entries per worker before the walker blocks
+QUEUE_DEPTH = 64
+
+# Source paths never copied to the target. The directories themselves are
+# kept as mount points, but the live user's home, the image's own
+# lost+found and the kernels (managed by clr-boot-manager) are not.
+COPY_EXCLUDES = [
+    "home/*",
+    "lost+found/*",
+    "boot/*",
+]
+
+# Digest used to verify copied files, matching sha256sum lists
+VERIFY_HASH = "sha256"
+
+# Copied files that may wait on the verifier, some with their source pages
+# held in the cache, before the workers block
+VERIFY_QUEUE_DEPTH = 64
+
+# Mismatching paths listed in the error before we summarise the rest
+MAX_REPORTED_MISMATCHES = 10
+
+# Seconds over which throughput readings are smoothed
+RATE_SMOOTHING = 5.0
+
+# Enough of the ext* superblock layout to recognise an image
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC_OFFSET = 0x38
+EXT_MAGIC = 0xEF53
+
+# Errors meaning "this method won't work here", not "the copy failed"
+UNSUPPORTED_ERRNOS = [
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+]
+
+
+def load_copy_excludes(path=SOURCE_EXCLUDES):
+    """ COPY_EXCLUDES, plus any globs the media lists in path. Blank lines
+        and comments are skipped, and globs are taken relative to the
+        source root whether or not they start with / or ./ """
+    excludes = list(COPY_EXCLUDES)
+    try:
+        with open(path, "r") as inp:
+            lines = inp.readlines()
+    except IOError:
+        return excludes
+    for line in lines:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if line.startswith("./"):
+            line = line[2:]
+        line = line.lstrip("/")
+        if line and line not in excludes:
+            excludes.append(line)
+    return excludes
+
+
+def get_default_workers():
+    """ Pick a sensible number of copy threads for this machine """
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return max(2, min(MAX_WORKERS, cpus))
+
+
+def is_sparse(st):
+    """ Determine if fewer blocks are allocated than the length implies """
+    return st.st_blocks * STAT_BLOCK_SIZE < st.st_size
+
+
+def get_copied_size(st):
+    """ Bytes the copy engine reports for one copy of this entry, which
+        for a sparse file is its allocation rather than its length """
+    if stat.S_ISREG(st.st_mode) and is_sparse(st):
+        return st.st_blocks * STAT_BLOCK_SIZE
+    return st.st_size
+
+
+def get_times_ns(st):
+    """ Return (atime, mtime) in nanoseconds. Python 2 only gives us float
+        seconds, which is as close as we can get there """
+    if hasattr(st, "st_mtime_ns"):
+        return (st.st_atime_ns, st.st_mtime_ns)
+    return (int(round(st.st_atime * syscalls.NSEC_PER_SEC)),
+            int(round(st.st_mtime * syscalls.NSEC_PER_SEC)))
+
+
+# Packed layout of a ManifestStat: mode, inode, device, link count, owner,
+# group, rdev, size and blocks, then atime and mtime in nanoseconds
+MANIFEST_STAT = struct.Struct("<9Q2q")
+
+
+def manifest_field(index):
+    """ Read-only property for one field of a ManifestStat """
+    return property(lambda self: MANIFEST_STAT.unpack(self)[index])
+
+
+class ManifestStat(bytes):
+    """ Just the parts of an lstat result the copy needs, under the same
+        names. A full stat result per entry, with every field its own
+        object, adds up to hundreds of MB for a whole OS, held in the RAM
+        of a live session for the entire copy. This packs them into a
+        single small bytes object instead """
+
+    __slots__ = ()
+
+    st_mode = manifest_field(0)
+    st_ino = manifest_field(1)
+    st_dev = manifest_field(2)
+    st_nlink = manifest_field(3)
+    st_uid = manifest_field(4)
+    st_gid = manifest_field(5)
+    st_rdev = manifest_field(6)
+    st_size = manifest_field(7)
+    st_blocks = manifest_field(8)
+    st_atime_ns = manifest_field(9)
+    st_mtime_ns = manifest_field(10)
+
+    @classmethod
+    def from_stat(cls, st):
+        """ Boil an lstat result down """
+        atime, mtime = get_times_ns(st)
+        return cls(MANIFEST_STAT.pack(
+            st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid,
+            st.st_gid, st.st_rdev, st.st_size, st.st_blocks, atime, mtime))
+
+    @property
+    def st_atime(self):
+        """ Float seconds, as os.utime wants """
+        return self.st_atime_ns / float(syscalls.NSEC_PER_SEC)
+
+    @property
+    def st_mtime(self):
+        """ Float seconds, as os.utime wants """
+        return self.st_mtime_ns / float(syscalls.NSEC_PER_SEC)
+
+
+def copy_xattrs(src_fd, dst_fd):
+    """ Clone every extended attribute, including file capabilities """
+    try:
+        names = syscalls.flistxattr(src_fd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            return
+        raise
+    for name in names:
+        value = syscalls.fgetxattr(src_fd, name)
+        try:
+            syscalls.fsetxattr(dst_fd, name, value)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+
+
+def clone_metadata(src_fd, dst_fd, st):
+    """ Apply ownership, mode, xattrs and times through the open fds.
+        chown drops setuid bits and capabilities, so it must come first """
+    os.fchown(dst_fd, st.st_uid, st.st_gid)
+    os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+    copy_xattrs(src_fd, dst_fd)
+    atime, mtime = get_times_ns(st)
+    syscalls.futimens(dst_fd, atime, mtime)
+
+
+def drop_page_cache(fd, offset=0, length=0):
+    """ Best-effort eviction of clean cached pages, 0 length meaning EOF """
+    try:
+        syscalls.posix_fadvise(fd, offset, length,
+                               syscalls.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+class WritebackWindow:
+    """ Keep writeback flowing steadily while a thread copies files.
+
+        Left alone, the kernel lets the copy dirty a large share of memory
+        and only flushes it at the final sync, starving a live session that
+        is often running from RAM and stalling the end of the install.
+        Instead writeback is started as soon as data lands, and once it has
+        completed the now clean pages are dropped from the cache. Recently
+        finished files are held open in a short window so their writeback
+        can proceed in the background before we wait on it. """
+
+    # Finished descriptors, oldest first, that we now own
+    fds = None
+    depth = 0
+
+    # Cleared if the kernel won't do sync_file_range for us
+    enabled = True
+
+    def __init__(self, depth=WRITEBACK_DEPTH):
+        self.fds = collections.deque()
+        self.depth = depth
+
+    def sync_range(self, fd, offset, length, flags):
+        """ sync_file_range that gives up quietly where unsupported """
+        if not self.enabled:
+            return
+        try:
+            syscalls.sync_file_range(fd, offset, length, flags)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            self.enabled = False
+
+    def settle_range(self, fd, offset, length):
+        """ Wait for a range to hit the disk, then forget about it """
+        self.sync_range(fd, offset, length, SYNC_AND_WAIT)
+        drop_page_cache(fd, offset, length)
+
+    def written(self, fd, start, end):
+        """ Data between start and end has just been written. Start it on
+            its way to disk and settle everything before it """
+        self.sync_range(fd, start, end - start,
+                        syscalls.SYNC_FILE_RANGE_WRITE)
+        if start > 0:
+            self.settle_range(fd, 0, start)
+
+    def retire(self, fd):
+        """ Take ownership of a finished file, closing it once settled """
+        self.fds.append(fd)
+        try:
+            self.sync_range(fd, 0, 0, syscalls.SYNC_FILE_RANGE_WRITE)
+        finally:
+            while len(self.fds) > self.depth:
+                self.settle(self.fds.popleft())
+
+    def settle(self, fd):
+        """ Complete writeback of a whole file and close it """
+        try:
+            self.settle_range(fd, 0, 0)
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        """ Settle every file still in the window """
+        while self.fds:
+            self.settle(self.fds.popleft())
+
+
+class FileCopier:
+    """ Copy file payloads without dragging them through Python.
+
+        copy_file_range is tried first, then sendfile, and only if the
+        kernel refuses both do we fall back to a large buffer loop. Sparse
+        files only have their data extents copied. Every transferred chunk
+        is reported to progress_func so the caller can keep its byte
+        counters current, meaning holes are never counted. """
+
+    # Learned at runtime, so we only pay for a refusal once
+    have_copy_range = True
+    have_sendfile = True
+
+    # Called with the byte count of each completed chunk
+    progress_func = None
+
+    # Optional WritebackWindow managing the page cache
+    window = None
+
+    def __init__(self, progress_func=None, window=None):
+        self.progress_func = progress_func
+        self.window = window
+
+    def report(self, count):
+        """ Pass progress back to our owner """
+        if self.progress_func and count > 0:
+            self.progress_func(count)
+
+    def copy_range(self, src_fd, dst_fd, remaining):
+        """ Use copy_file_range, returning the bytes left uncopied """
+        while remaining > 0:
+            try:
+                n = syscalls.copy_file_range(
+                    src_fd, dst_fd, min(remaining, TRANSFER_CHUNK))
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.have_copy_range = False
+                break
+            if n == 0:
+                # Some filesystems report EOF early, let sendfile finish
+                break
+            remaining -= n
+            self.report(n)
+        return remaining
+
+    def copy_sendfile(self, src_fd, dst_fd, remaining):
+        """ Use sendfile, returning the bytes left uncopied """
+        while remaining > 0:
+            try:
+                n = syscalls.sendfile(
+                    dst_fd, src_fd, min(remaining, TRANSFER_CHUNK))
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.have_sendfile = False
+                break
+            if n == 0:
+                break
+            remaining -= n
+            self.report(n)
+        return remaining
+
+    def copy_buffered(self, src_fd, dst_fd, remaining):
+        """ Last resort, read/write the remainder """
+        while remaining > 0:
+            buf = os.read(src_fd, min(remaining, FALLBACK_BUF_SIZE))
+            if not buf:
+                break
+            view = memoryview(buf)
+            while len(view) > 0:
+                n = os.write(dst_fd, view)
+                view = view[n:]
+            remaining -= len(buf)
+            self.report(len(buf))
+
+    def copy_chunk(self, src_fd, dst_fd, length):
+        """ Copy length bytes from the current offset of src_fd to dst_fd """
+        remaining = length
+        if remaining > 0 and self.have_copy_range:
+            remaining = self.copy_range(src_fd, dst_fd, remaining)
+        if remaining > 0 and self.have_sendfile:
+            remaining = self.copy_sendfile(src_fd, dst_fd, remaining)
+        # The kernel may have stopped short, finish up by hand
+        self.copy_buffered(src_fd, dst_fd, remaining)
+
+    def copy_data(self, src_fd, dst_fd, length):
+        """ Copy length bytes, handing each written piece to our window """
+        if not self.window:
+            self.copy_chunk(src_fd, dst_fd, length)
+            return
+        pos = os.lseek(dst_fd, 0, os.SEEK_CUR)
+        end = pos + length
+        while pos < end:
+            step = min(end - pos, WRITEBACK_CHUNK)
+            self.copy_chunk(src_fd, dst_fd, step)
+            self.window.written(dst_fd, pos, pos + step)
+            pos += step
+
+    def copy_sparse(self, src_fd, dst_fd, size):
+        """ Copy only the data extents of a sparse file, leaving the holes
+            unwritten. Returns False if the kernel can't find the extents """
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(src_fd, pos, syscalls.SEEK_DATA)
+            except OSError as e:
+                # ENXIO means there is no data past pos
+                if e.errno == errno.ENXIO:
+                    break
+                if pos == 0 and e.errno in UNSUPPORTED_ERRNOS:
+                    return False
+                raise
+            end = os.lseek(src_fd, start, syscalls.SEEK_HOLE)
+            os.lseek(src_fd, start, os.SEEK_SET)
+            os.lseek(dst_fd, start, os.SEEK_SET)
+            self.copy_data(src_fd, dst_fd, end - start)
+            pos = end
+        # Trailing holes need the length set explicitly
+        os.ftruncate(dst_fd, size)
+        return True
+
+    def copy_fd(self, src_fd, dst_fd, st, keep_source=False):
+        """ Copy the payload of an open file, given its stat result. The
+            source pages stay cached with keep_source, for a verifier """
+        if self.window:
+            # Read once, front to back, and never again
+            for advice in [syscalls.POSIX_FADV_SEQUENTIAL,
+                           syscalls.POSIX_FADV_NOREUSE]:
+                try:
+                    syscalls.posix_fadvise(src_fd, 0, 0, advice)
+                except OSError:
+                    pass
+
+        if not is_sparse(st) or \
+                not self.copy_sparse(src_fd, dst_fd, st.st_size):
+            self.copy_data(src_fd, dst_fd, st.st_size)
+
+        if self.window and not keep_source:
+            drop_page_cache(src_fd)
+
+    def copy_file(self, source, dest):
+        """ Copy the regular file at source to a new file at dest """
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o0600)
+            try:
+                self.copy_fd(src_fd, dst_fd, os.fstat(src_fd))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+
+class CopyManifest:
+    """ Single-pass inventory of a source tree.
+
+        Every entry is recorded once along with its lstat result, so the
+        copy never needs to look a source path up again, and the total is
+        exactly the number of bytes the copy will report: sparse files by
+        their allocation and multiply-linked files only once. """
+
+    # Top of the source tree
+    root = None
+
+    # (relative path, ManifestStat) of every directory, parents before
+    # children
+    directories = None
+
+    # (relative path, ManifestStat) of everything else
+    entries = None
+
+    # Bytes the copy will report on completion
+    total_size = 0
+
+    # Globs, relative to root, of paths to leave out entirely
+    excludes = None
+
+    def __init__(self, root, excludes=None):
+        self.root = root
+        self.directories = []
+        self.entries = []
+        if excludes is None:
+            excludes = COPY_EXCLUDES
+        self.excludes = excludes
+
+    def get_entry_size(self, st, seen):
+        """ How many bytes the copy engine will report for this entry """
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            if key in seen:
+                return 0
+            seen.add(key)
+        return get_copied_size(st)
+
+    def list_dir(self, path):
+        """ Yield (name, stat) for each child of path, lstat'd """
+        if scandir:
+            for entry in scandir(path):
+                yield (entry.name, entry.stat(follow_symlinks=False))
+            return
+        for name in os.listdir(path):
+            yield (name, os.lstat(os.path.join(path, name)))
+
+    def is_excluded(self, path):
+        """ Determine if the relative path matches an exclusion glob """
+        for pattern in self.excludes:
+            if fnmatch.fnmatchcase(path, pattern):
+                return True
+        return False
+
+    def scan(self):
+        """ Walk the tree top-down and record everything within it,
+            pruning excluded subtrees before ever descending into them """
+        seen = set()
+        self.total_size = 0
+        pending = [""]
+        while pending:
+            dir_root = pending.pop()
+            subdirs = []
+            for name, st in self.list_dir(os.path.join(self.root, dir_root)):
+                path = os.path.join(dir_root, name)
+                # Don't traverse what we don't need
+                if self.is_excluded(path):
+                    continue
+                st = ManifestStat.from_stat(st)
+                self.total_size += self.get_entry_size(st, seen)
+                if stat.S_ISDIR(st.st_mode):
+                    self.directories.append((path, st))
+                    subdirs.append(path)
+                else:
+                    self.entries.append((path, st))
+            # Pop in listing order, so children always follow parents
+            subdirs.reverse()
+            pending.extend(subdirs)
+
+    def get_copy_order(self):
+        """ Order entries by source inode, which on the loop-mounted image
+            tracks on-disk position far better than directory order. Sorted
+            in place, so we don't hold a second list of everything """
+        self.entries.sort(key=lambda x: x[1].st_ino)
+        return self.entries
+
+
+class CopyProgress:
+    """ Byte and file counters for the current phase of a copy.
+
+        Every thread owns a slot that only it writes to, so the hot path
+        is a couple of integer additions with no locking or formatting.
+        Readers sum the slots, and a momentarily stale total is harmless
+        for display. Smoothed rates are derived in sample(), which the UI
+        calls from its own timer. """
+
+    # Name of the current phase, for display
+    phase = None
+    started = 0
+
+    # One [bytes, files, current path] list per writing thread
+    slots = None
+
+    # State for the smoothed rates
+    last_time = 0
+    last_bytes = 0
+    last_files = 0
+    byte_rate = None
+    file_rate = None
+
+    def __init__(self, num_slots, phase=None):
+        self.slots = [[0, 0, None] for i in range(0, num_slots)]
+        self.set_phase(phase)
+
+    def set_phase(self, phase):
+        """ Enter a new phase, restarting the clock and rates """
+        self.phase = phase
+        self.started = time.time()
+        self.last_time = self.started
+        self.last_bytes = self.get_bytes()
+        self.last_files = self.get_files()
+        self.byte_rate = None
+        self.file_rate = None
+
+    def add_bytes(self, slot, count):
+        """ Account for copied bytes, only ever from the slot's owner """
+        self.slots[slot][0] += count
+
+    def add_file(self, slot, path):
+        """ Account for a started entry, only ever from the slot's owner """
+        entry = self.slots[slot]
+        entry[1] += 1
+        entry[2] = path
+
+    def get_bytes(self):
+        return sum([x[0] for x in self.slots])
+
+    def get_files(self):
+        return sum([x[1] for x in self.slots])
+
+    def get_current(self):
+        """ A recently started path, for display """
+        for entry in self.slots:
+            if entry[2]:
+                return entry[2]
+        return None
+
+    def get_elapsed(self):
+        """ Seconds spent in the current phase """
+        return time.time() - self.started
+
+    def sample(self):
+        """ Fold the progress since the last sample into the smoothed
+            byte and file rates """
+        now = time.time()
+        delta = now - self.last_time
+        if delta <= 0:
+            return
+        cur_bytes = self.get_bytes()
+        cur_files = self.get_files()
+        byte_rate = (cur_bytes - self.last_bytes) / delta
+        file_rate = (cur_files - self.last_files) / delta
+        self.last_time = now
+        self.last_bytes = cur_bytes
+        self.last_files = cur_files
+
+        if self.byte_rate is None:
+            self.byte_rate = byte_rate
+            self.file_rate = file_rate
+            return
+        weight = 1.0 - math.exp(-delta / RATE_SMOOTHING)
+        self.byte_rate += weight * (byte_rate - self.byte_rate)
+        self.file_rate += weight * (file_rate - self.file_rate)
+
+    def get_eta(self, total):
+        """ Estimated seconds until total bytes are done, or None """
+        if not self.byte_rate or self.byte_rate <= 0:
+            return None
+        remaining = total - self.get_bytes()
+        if remaining <= 0:
+            return 0
+        return remaining / self.byte_rate
+
+
+class CopyVerifier:
+    """ Verify copied files on a thread of its own.
+
+        The copy engine keeps file data inside the kernel, so instead of
+        hashing the stream in flight, each completed file is flushed to
+        disk, dropped from the page cache and read back from the media, so
+        a bad write can't hide behind cached pages. It is compared against
+        either a build-time digest list or a digest of the source, read
+        while its pages are still hot from the copy. Running behind the
+        workers means writes only wait on us once the bounded queue fills.
+        Nothing here can see past the drive's own write cache. """
+
+    # Top of the source and target trees
+    source = None
+    target = None
+
+    # Relative path -> expected hex digest, from a build-time list
+    digests = None
+
+    # Relative paths which failed verification
+    mismatches = None
+
+    thread = None
+    queue = None
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.digests = dict()
+        self.mismatches = []
+
+    def load_digests(self, digest_file):
+        """ Read a sha256sum style list of paths relative to the source """
+        with open(digest_file, "r") as inp:
+            for line in inp.readlines():
+                line = line.replace("\r", "").replace("\n", "").strip()
+                if line == "" or line.startswith("#"):
+                    continue
+                splits = line.split(None, 1)
+                if len(splits) != 2:
+                    continue
+                path = splits[1].lstrip("*")
+                if path.startswith("./"):
+                    path = path[2:]
+                self.digests[path.lstrip("/")] = splits[0].lower()
+
+    def hash_file(self, path, from_media=False):
+        """ Hex digest of the file at path. With from_media, it is first
+            flushed and evicted so we read what actually hit the disk """
+        h = hashlib.new(VERIFY_HASH)
+        with open(path, "rb") as inp:
+            if from_media:
+                os.fdatasync(inp.fileno())
+                drop_page_cache(inp.fileno())
+            while True:
+                buf = inp.read(FALLBACK_BUF_SIZE)
+                if not buf:
+                    break
+                h.update(buf)
+            # The copy left these pages for us, nobody needs them now
+            drop_page_cache(inp.fileno())
+        return h.hexdigest()
+
+    def needs_source(self, path):
+        """ Determine if checking path means hashing the source too """
+        return path not in self.digests
+
+    def verify(self, path):
+        """ Compare one copied file against its expected digest """
+        try:
+            expected = self.digests.get(path)
+            if expected is None:
+                expected = self.hash_file(os.path.join(self.source, path))
+            actual = self.hash_file(os.path.join(self.target, path), True)
+        except Exception as e:
+            print("Cannot verify /{}: {}".format(path, e))
+            self.mismatches.append(path)
+            return
+        if actual != expected:
+            self.mismatches.append(path)
+
+    def run(self):
+        """ Verify submitted paths until told to stop """
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            self.verify(path)
+
+    def start(self):
+        self.queue = queue.Queue(maxsize=VERIFY_QUEUE_DEPTH)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, path):
+        """ Queue a relative path for checking, blocking while the queue is
+            full """
+        self.queue.put(path)
+
+    def finish(self):
+        """ Wait for every submitted path to be checked """
+        self.queue.put(None)
+        self.thread.join()
+        return len(self.mismatches) == 0
+
+    def get_mismatches(self):
+        return sorted(self.mismatches)
+
+
+class SystemCopier:
+    """ Copy an entire filesystem tree from source to target.
+
+        The directory skeleton is created up front from a CopyManifest,
+        then regular files and special nodes are fanned out across a pool
+        of worker threads in the manifest's read order, overlapping the
+        per-file syscall latency. Directory ownership, mode and times are
+        only applied once every child is done, bottom-up, so restrictive
+        modes can't block the workers and times stay intact. """
+
+    # Mount points of the source tree and the target tree
+    source = None
+    target = None
+
+    # Scanned inventory of the source
+    manifest = None
+
+    # Our worker threads and their queue
+    num_workers = 0
+    workers = None
+    queue = None
+
+    # Per-phase counters, slot 0 belongs to the calling thread
+    progress = None
+
+    # Per-thread progress slot and payload mover
+    local = None
+
+    # First error encountered, workers stop when this is set
+    errors = None
+    lock = None
+
+    # Mapping of (st_dev, st_ino) -> (target path, completion event) for
+    # every multiply-linked file we've started copying
+    inodes = None
+
+    # Optional CopyVerifier checking files behind the workers
+    verifier = None
+
+    # Whether the target holds an earlier, interrupted copy to complete
+    resume = False
+
+    def __init__(self, manifest, target, num_workers=None, verifier=None,
+                 resume=False):
+        self.manifest = manifest
+        self.verifier = verifier
+        self.resume = resume
+        self.source = manifest.root
+        self.target = target
+        if not num_workers:
+            num_workers = get_default_workers()
+        self.num_workers = num_workers
+        self.lock = threading.Lock()
+        self.inodes = dict()
+        self.progress = CopyProgress(num_workers + 1)
+        self.local = threading.local()
+
+    def bind_slot(self, slot):
+        """ Give the calling thread its own progress slot and copier """
+        self.local.slot = slot
+        self.local.window = WritebackWindow()
+        self.local.copier = FileCopier(self.report, self.local.window)
+
+    def report(self, count):
+        """ Account for copied bytes """
+        if count > 0:
+            self.progress.add_bytes(self.local.slot, count)
+
+    def set_errors(self, er):
+        """ Record the first error encountered, later ones are noise """
+        with self.lock:
+            if self.errors is None:
+                self.errors = er
+
+    def get_errors(self):
+        """ Get the errors, if any, encountered """
+        return self.errors
+
+    def failed(self):
+        """ Determine if any part of the copy has failed """
+        return self.errors is not None
+
+    def worker(self, slot):
+        """ Copy queued entries until told to stop """
+        self.bind_slot(slot)
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    self.flush_window()
+                    return
+                if self.failed():
+                    continue
+                self.copy_entry(job[0], job[1])
+            finally:
+                self.queue.task_done()
+
+    def flush_window(self):
+        """ Settle whatever the calling thread still has in flight """
+        try:
+            self.local.window.flush()
+        except Exception as ex:
+            self.set_errors("Failed to write back files: {}".format(ex))
+
+    def start_workers(self):
+        """ Spin up the worker pool """
+        self.queue = queue.Queue(maxsize=self.num_workers * QUEUE_DEPTH)
+        self.workers = []
+        for i in range(0, self.num_workers):
+            t = threading.Thread(target=self.worker, args=(i + 1,))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def stop_workers(self):
+        """ Wait for all queued work to complete and reap the workers """
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+
+    def check_verified(self):
+        """ Turn any verification failures into our errors """
+        bad = self.verifier.get_mismatches()
+        if not bad:
+            return True
+        for path in bad:
+            print("Verification failed: /{}".format(path))
+        listed = ["/{}".format(x) for x in bad[:MAX_REPORTED_MISMATCHES]]
+        if len(bad) > len(listed):
+            listed.append("and {} more".format(len(bad) - len(listed)))
+        self.set_errors("Copied files failed verification:\n{}".format(
+            "\n".join(listed)))
+        return False
+
+    def claim_inode(self, st, target_path):
+        """ Register a multiply-linked file. Returns None when the caller now
+            owns the copy, otherwise the (path, event) of the first link """
+        key = (st.st_dev, st.st_ino)
+        with self.lock:
+            first = self.inodes.get(key)
+            if first is None:
+                self.inodes[key] = (target_path, threading.Event())
+        return first
+
+    def is_copied(self, target_path, st):
+        """ Determine if an interrupted copy already completed this entry.
+            Times are always applied last, so matching them is proof enough.
+            Anything else found in the way is removed, including a whole
+            directory where the source no longer has one """
+        try:
+            tst = os.lstat(target_path)
+        except OSError:
+            return False
+        if stat.S_IFMT(tst.st_mode) == stat.S_IFMT(st.st_mode) and \
+                tst.st_size == st.st_size and \
+                get_times_ns(tst)[1] == get_times_ns(st)[1]:
+            return True
+        self.clear_target(target_path, tst)
+        return False
+
+    def clear_target(self, target_path, tst):
+        """ Remove whatever an earlier copy left at target_path """
+        if stat.S_ISDIR(tst.st_mode):
+            shutil.rmtree(target_path)
+        else:
+            os.unlink(target_path)
+
+    def copy_regular(self, path, source_path, target_path, st):
+        """ Copy a regular file and its metadata without further lookups """
+        src_fd = os.open(source_path, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            dst_fd = os.open(target_path,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o0600)
+            try:
+                keep = self.verifier is not None and \
+                    self.verifier.needs_source(path)
+                self.local.copier.copy_fd(src_fd, dst_fd, st, keep)
+                clone_metadata(src_fd, dst_fd, st)
+            except Exception:
+                os.close(dst_fd)
+                raise
+            # Closed once its writeback completes
+            self.local.window.retire(dst_fd)
+        finally:
+            os.close(src_fd)
+        if self.verifier:
+            self.verifier.submit(path)
+
+    def copy_entry(self, path, st):
+        """ Copy a single non-directory entry across """
+        source_path = os.path.join(self.source, path)
+        target_path = os.path.join(self.target, path)
+        self.progress.add_file(self.local.slot, path)
+
+        claimed = None
+        try:
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                first = self.claim_inode(st, target_path)
+                if first is not None:
+                    # Data, ownership and mode all live on the shared inode
+                    first[1].wait()
+                    if not self.failed():
+                        if self.resume and os.path.lexists(target_path):
+                            self.clear_target(target_path,
+                                              os.lstat(target_path))
+                        os.link(first[0], target_path)
+                    return
+                claimed = self.inodes[(st.st_dev, st.st_ino)][1]
+
+            if self.resume and self.is_copied(target_path, st):
+                if self.verifier and stat.S_ISREG(st.st_mode):
+                    self.verifier.submit(path)
+                # Match what the manifest counted, not the apparent length
+                self.report(get_copied_size(st))
+                return
+
+            mode = stat.S_IMODE(st.st_mode)
+            is_link = False
+
+            if stat.S_ISLNK(st.st_mode):
+                linkto = os.readlink(source_path)
+                os.symlink(linkto, target_path)
+                is_link = True
+            elif stat.S_ISCHR(st.st_mode):
+                os.mknod(target_path, stat.S_IFCHR | mode, st.st_rdev)
+            elif stat.S_ISBLK(st.st_mode):
+                os.mknod(target_path, stat.S_IFBLK | mode, st.st_rdev)
+            elif stat.S_ISFIFO(st.st_mode):
+                os.mknod(target_path, stat.S_IFIFO | mode)
+            elif stat.S_ISSOCK(st.st_mode):
+                os.mknod(target_path, stat.S_IFSOCK | mode)
+            elif stat.S_ISREG(st.st_mode):
+                # Handles all of its own metadata
+                self.copy_regular(path, source_path, target_path, st)
+                return
+
+            # Chown it.
+            os.lchown(target_path, st.st_uid, st.st_gid)
+            if not is_link:
+                # Copy permissiions/utime
+                os.chmod(target_path, mode)
+                os.utime(target_path, (st.st_atime, st.st_mtime))
+            self.report(st.st_size)
+        except Exception as ex:
+            self.set_errors("Failed to copy {}: {}".format(source_path, ex))
+        finally:
+            # Release anyone waiting to link against us
+            if claimed:
+                claimed.set()
+
+    def finalize_dir(self, path, st):
+        """ Apply ownership, mode and times to a completed directory """
+        source_path = os.path.join(self.source, path)
+        target_path = os.path.join(self.target, path)
+        self.progress.add_file(self.local.slot, path)
+
+        flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+        src_fd = os.open(source_path, flags)
+        try:
+            dst_fd = os.open(target_path, flags)
+            try:
+                clone_metadata(src_fd, dst_fd, st)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        # Update progress
+        self.report(st.st_size)
+
+    def copy(self):
+        """ Copy the whole tree, returning True on success """
+        manifest = self.manifest
+        self.bind_slot(0)
+
+        # Lay out the skeleton first, so files can land in any order
+        self.progress.set_phase("Creating directories")
+        for path, st in manifest.directories:
+            target_dir = os.path.join(self.target, path)
+            if os.path.exists(target_dir):
+                continue
+            try:
+                # We set the permissions up properly later
+                os.makedirs(target_dir, 0o0755)
+            except Exception as ex:
+                self.set_errors("Cannot create dir: {}".format(ex))
+                return False
+
+        self.progress.set_phase("Copying files")
+        if self.verifier:
+            self.verifier.start()
+        self.start_workers()
+        try:
+            for path, st in manifest.get_copy_order():
+                if self.failed():
+                    break
+                self.queue.put((path, st))
+        finally:
+            self.stop_workers()
+            if self.verifier:
+                self.progress.set_phase("Verifying copied files")
+                self.verifier.finish()
+        if self.failed():
+            return False
+        if self.verifier and not self.check_verified():
+            return False
+
+        # Every child is in place, now lock down the directories bottom-up,
+        # meaning we set perms/time on everything but / itself
+        self.progress.set_phase("Applying directory permissions")
+        for path, st in reversed(manifest.directories):
+            try:
+                self.finalize_dir(path, st)
+            except Exception as ex:
+                self.set_errors("Permissions issue: {} {}".format(
+                    ex, path))
+                return False
+        return True
+
+
+class ImageStreamer:
+    """ Stream an ext* filesystem image straight onto a block device.
+
+        e2image only writes the blocks the image actually has allocated,
+        so the install becomes one mostly sequential write instead of a
+        metadata-bound copy of every file. Afterwards the filesystem is
+        grown to fill the device and given a fresh UUID, as every install
+        would otherwise share the UUID baked into the live image. """
+
+    # Path to the filesystem image
+    image = None
+
+    # Block device node to overwrite
+    device = None
+
+    errors = None
+
+    def __init__(self, image, device):
+        self.image = image
+        self.device = device
+
+    def set_errors(self, er):
+        """ Set the errors encountered """
+        self.errors = er
+
+    def get_errors(self):
+        """ Get the errors, if any, encountered """
+        return self.errors
+
+    def describe(self):
+        return "Writing system image to {}".format(self.device)
+
+    def is_ext_image(self):
+        """ Only ext* images can be streamed and resized """
+        try:
+            with open(self.image, "rb") as img:
+                img.seek(EXT_SUPERBLOCK_OFFSET + EXT_MAGIC_OFFSET)
+                magic = struct.unpack("<H", img.read(2))[0]
+        except Exception as e:
+            print("Cannot read image superblock: {}".format(e))
+            return False
+        return magic == EXT_MAGIC
+
+    def get_device_size(self):
+        """ Byte length of the target device """
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            return os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+
+    def is_possible(self):
+        """ Determine whether the image will fit and can be handled """
+        if not os.path.exists(self.image):
+            return False
+        if not self.is_ext_image():
+            return False
+        try:
+            image_size = os.stat(self.image).st_size
+            device_size = self.get_device_size()
+        except Exception as e:
+            print("Cannot size image or device: {}".format(e))
+            return False
+        if image_size > device_size:
+            print("DEBUG: Image too large to stream to {}".format(
+                self.device))
+            return False
+        return True
+
+    def prune(self, root, excludes=None):
+        """ Delete whatever within the mounted root the file copy would
+            have left out, as the image brings along everything. Returns
+            False on failure """
+        if excludes is None:
+            excludes = COPY_EXCLUDES
+        manifest = CopyManifest(root, excludes)
+        for dir_root, dirs, files in os.walk(root):
+            rel = os.path.relpath(dir_root, root)
+            if rel == ".":
+                rel = ""
+            # Symlinks to directories are listed in dirs, but not walked
+            for name in dirs + files:
+                path = os.path.join(rel, name)
+                if not manifest.is_excluded(path):
+                    continue
+                fpath = os.path.join(root, path)
+                try:
+                    if os.path.isdir(fpath) and not os.path.islink(fpath):
+                        shutil.rmtree(fpath)
+                    else:
+                        os.unlink(fpath)
+                except Exception as e:
+                    self.set_errors("Cannot remove {}: {}".format(fpath, e))
+                    return False
+            # Don't descend into what we just removed
+            dirs[:] = [x for x in dirs
+                       if not manifest.is_excluded(os.path.join(rel, x))]
+        return True
+
+    def stream(self):
+        """ Write, check, grow and re-identify the filesystem """
+        cmds = [
+            "e2image -ra \"{}\" {}".format(self.image, self.device),
+            "/sbin/e2fsck -f -p {}".format(self.device),
+            "/sbin/resize2fs {}".format(self.device),
+            "tune2fs -U random {}".format(self.device),
+        ]
+        for cmd in cmds:
+            try:
+                subprocess.check_call(cmd, shell=True)
+            except Exception as e:
+                self.set_errors("{}: {}".format(self.device, e))
+                return False
+        return True
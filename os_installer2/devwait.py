@@ -0,0 +1,81 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from .syscalls import inotify_init1, inotify_add_watch
+from .syscalls import IN_CLOEXEC, IN_CREATE, IN_MOVED_TO
+import errno
+import os
+import select
+import time
+
+# How long a whole disk plan gets for its device nodes to show up once the
+# partition table is committed
+NODE_WAIT_TIMEOUT = 10.0
+
+# How often to look again when we can't watch a directory, i.e. inotify is
+# missing or the directory doesn't exist yet
+NODE_POLL_INTERVAL = 0.1
+
+INOTIFY_READ_SIZE = 16 * 1024
+
+
+def wait_for_nodes(paths, timeout=NODE_WAIT_TIMEOUT):
+    """ Wait until every one of paths exists, or timeout seconds pass.
+        Returns those still missing, in order.
+
+        The directories holding them are watched with inotify, so we wake
+        the moment devtmpfs or udev creates anything there rather than
+        sleeping a fixed amount per node. """
+    missing = list(paths)
+    deadline = time.time() + timeout
+    fd = None
+    watching = False
+    try:
+        try:
+            fd = inotify_init1(IN_CLOEXEC)
+        except OSError as e:
+            print("Cannot watch for device nodes: {}".format(e))
+        if fd is not None:
+            # Watch before looking, so nothing slips in between
+            watching = True
+            for dirname in set(os.path.dirname(x) for x in missing):
+                try:
+                    inotify_add_watch(fd, dirname, IN_CREATE | IN_MOVED_TO)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        print("Cannot watch {}: {}".format(dirname, e))
+                    watching = False
+
+        while True:
+            missing = [x for x in missing if not os.path.exists(x)]
+            if not missing:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if not watching:
+                remaining = min(remaining, NODE_POLL_INTERVAL)
+            if fd is None:
+                time.sleep(remaining)
+                continue
+            try:
+                ready, _, _ = select.select([fd], [], [], remaining)
+            except select.error:
+                continue
+            # Which names turned up doesn't matter, only that we look again
+            if ready:
+                os.read(fd, INOTIFY_READ_SIZE)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return missing
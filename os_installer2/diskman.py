@@ -13,15 +13,222 @@
 
 from . import format_size_local
 from . import MIN_REQUIRED_SIZE
+from .blockdev import BlockInventory, MIN_ALIGNMENT, get_block_device
+from .lvm import find_physical_volumes, get_lvm_report
+from .mounts import MountManager
+from .permissions import PrivilegedWorker
+from .probecache import ProbeCache, get_table_key
+from .signatures import SignatureScanner, utf16_signature
+from .superblock import read_filesystem_info
 from gi.repository import GObject
-import re
 import os
 import subprocess
 import tempfile
+import threading
 import time
 import parted
 import struct
 
+# Upper bound on partitions being probed at once
+PROBE_WORKERS = 8
+
+# Seconds we'll wait on any one partition before giving up on it
+PROBE_TIMEOUT = 30
+
+
+class PartitionProber:
+    """ Probe many partitions at once, each against its own deadline.
+
+        Every partition needs mounting, inspecting and measuring, which is
+        mostly spent waiting on disks and helper tools, so they're probed
+        concurrently. Threads can't be cancelled, so a partition that
+        overruns its deadline is simply abandoned: it is reported as
+        having nothing on it, and a new probe takes its place, so one dead
+        disk can't hold up the rest. """
+
+    # Our disk manager and the current mount points
+    dm = None
+    mpoints = None
+
+    timeout = 0
+    max_workers = 0
+
+    # Mapping of partition path -> (SystemPartition, OsType)
+    results = None
+
+    # Guards results, notified as each probe completes
+    cond = None
+
+    # Optional ProbeCache to consult before probing, and fill after
+    cache = None
+
+    def __init__(self, dm, mpoints, timeout=PROBE_TIMEOUT,
+                 max_workers=PROBE_WORKERS, cache=None):
+        self.dm = dm
+        self.mpoints = mpoints
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.cache = cache
+        self.results = dict()
+        self.cond = threading.Condition()
+
+    def probe_cached(self, partition, path, table_key):
+        """ Probe a partition, unless the cache knows it hasn't changed """
+        # Mounted filesystems are live, their figures won't keep
+        if not self.cache or path in self.mpoints:
+            return self.dm.detect_operating_system_and_space(
+                partition, self.mpoints)
+
+        state = self.cache.lookup(path, self.cache.get_key(path, table_key))
+        if state is not None:
+            return self.dm.restore_probe_result(partition, state)
+
+        result = self.dm.detect_operating_system_and_space(
+            partition, self.mpoints)
+        # Key it on the aftermath, in case probing wrote to it
+        self.cache.store(path, self.cache.get_key(path, table_key),
+                         self.dm.get_probe_state(result))
+        return result
+
+    def get_fallback(self, partition):
+        """ What we know of a partition we couldn't probe: its size, but
+            nothing about its contents """
+        return (SystemPartition(partition, None, self.dm), None)
+
+    def probe_one(self, partition, path, table_key):
+        """ Probe a single partition, from a worker thread """
+        try:
+            result = self.probe_cached(partition, path, table_key)
+        except Exception as e:
+            print("Failed to probe {}: {}".format(path, e))
+            result = self.get_fallback(partition)
+        with self.cond:
+            # Too late if we've already given up on it
+            if path not in self.results:
+                self.results[path] = result
+            self.cond.notify()
+
+    def probe(self, partitions):
+        """ Probe all given partitions, returning a mapping of partition
+            path to (SystemPartition, OsType) """
+        # parted is left to this thread, workers only get plain values
+        pending = [(PartitionSnapshot(x), x.path, get_table_key(x))
+                   for x in partitions]
+        pending.reverse()
+        snapshots = dict((x[1], x[0]) for x in pending)
+        running = dict()
+
+        with self.cond:
+            while pending or running:
+                now = time.time()
+                for path in list(running):
+                    if path in self.results:
+                        del running[path]
+                    elif now - running[path] >= self.timeout:
+                        print("Gave up probing {} after {}s".format(
+                            path, self.timeout))
+                        self.results[path] = self.get_fallback(
+                            snapshots[path])
+                        del running[path]
+
+                while pending and len(running) < self.max_workers:
+                    partition, path, table_key = pending.pop()
+                    thr = threading.Thread(target=self.probe_one,
+                                           args=(partition, path, table_key))
+                    thr.daemon = True
+                    running[path] = time.time()
+                    thr.start()
+
+                if running:
+                    deadline = min(running.values()) + self.timeout
+                    self.cond.wait(max(deadline - time.time(), 0.01))
+        return self.results
+
+
+class PartitionSnapshot:
+    """ Plain values describing a parted.Partition, taken on the thread
+        that owns parted so that probing never has to call into it """
+
+    # The parted.Partition itself, carried along but never touched
+    partition = None
+
+    # i.e. /dev/sda3
+    path = None
+
+    # Filesystem type as libparted sees it, if it found one at all
+    has_filesystem = False
+    fstype = None
+
+    # In bytes
+    size = 0
+
+    def __init__(self, partition):
+        self.partition = partition
+        self.path = partition.path
+        if partition.fileSystem:
+            self.has_filesystem = True
+            self.fstype = partition.fileSystem.type
+        self.size = partition.getLength() * \
+            partition.disk.device.sectorSize
+
+
+class MinSizeCalculator:
+    """ Resolve exact minimum sizes in the background.
+
+        Finding how far a filesystem can shrink means scanning all of it,
+        which can take a long while, so partitions start out with an
+        estimate and this works through them one at a time afterwards, as
+        background jobs on the disk manager's PrivilegedWorker. Anyone
+        needing a figure before we get to it asks for it with prioritise()
+        and waits on the callback, rather than blocking on the scan. """
+
+    dm = None
+
+    # Bumped to drop everything queued so far
+    generation = 0
+
+    # Called from the worker with each partition as it's resolved
+    callback = None
+
+    def __init__(self, dm):
+        self.dm = dm
+
+    def set_callback(self, callback):
+        """ Have callback(partition) told of every resolved partition. It
+            runs on the worker, so GTK users must idle_add from there """
+        self.callback = callback
+
+    def submit(self, partitions):
+        """ Queue partitions up, largest first as those are the likeliest
+            to be resized """
+        for part in sorted(partitions, key=SystemPartition.getLength,
+                           reverse=True):
+            if not part.min_size_exact:
+                self.dm.worker.submit(self.resolve, (part, self.generation),
+                                      background=True)
+
+    def prioritise(self, part):
+        """ Resolve a partition ahead of all background work, as someone
+            is waiting on it """
+        self.dm.worker.submit(self.resolve, (part, self.generation))
+
+    def cancel(self):
+        """ Drop anything not yet started, i.e. partitions of a probe that
+            has since been superseded """
+        self.generation += 1
+
+    def resolve(self, part, generation):
+        """ Privileged worker job for a single partition """
+        if generation != self.generation or part.min_size_exact:
+            return
+        part.resolve_min_size()
+        # Don't lose the work to the next run
+        cache = self.dm.get_probe_cache()
+        if cache.update_partition(part.path, part.get_state()):
+            cache.save()
+        if self.callback:
+            self.callback(part)
+
 
 class DriveProber:
     """ Handle the mundane work of probing and querying all of the drives """
@@ -32,8 +239,16 @@ class DriveProber:
     drives = None
     mtab = None
 
+    # Works out the exact minimum sizes once probing is done, shared by
+    # every prober
+    sizer = None
+
+    # LvmReport, or None on systems without LVM2
+    lvm = None
+
     def __init__(self, dm):
         self.dm = dm
+        self.sizer = dm.sizer
 
     def get_drive(self, nom):
         """ Return a named drive """
@@ -42,14 +257,19 @@ class DriveProber:
                 return item
 
     def probe_lvm2(self):
-        cmds = ["/sbin/pvscan", "/sbin/vgscan", "/sbin/lvscan"]
-        for cmd in cmds:
-            try:
-                subprocess.check_call(cmd)
-            except Exception as e:
-                print("Failed to execute {}: {}".format(cmd, e))
-                return False
-        return True
+        """ Discover LVM2, but only if there are any PVs to speak of """
+        self.lvm = None
+        devices = self.dm.inventory.devices.values()
+        if not find_physical_volumes(devices):
+            return True
+        self.lvm = get_lvm_report()
+        return self.lvm is not None
+
+    def get_vg_name(self, base, drive_path):
+        """ Name for a new volume group on drive_path that won't clash """
+        if not self.lvm:
+            return base
+        return self.lvm.get_free_vg_name(base, drive_path)
 
     def collect_esp(self):
         """ util """
@@ -65,36 +285,117 @@ class DriveProber:
         """ Probe all the drives for juicy information """
         self.drives = list()
 
+        # Everything is about to be probed afresh
+        self.sizer.cancel()
+
         # Cache the current mount points, gonna need it.
         self.mtab = self.dm.get_mount_points()
         self.dm.scan_parts()
         self.probe_lvm2()
 
-        for item in self.dm.devices:
-            disk = None
-            device = None
-            try:
-                device = parted.getDevice(item)
-                if device.readOnly:
-                    print("DEBUG: Skipping read-only device")
-                    continue
-                size = device.getLength() * device.sectorSize
-                if size < MIN_REQUIRED_SIZE:
-                    print("DEBUG: Skipping tiny drive: {}".format(
-                          device.path))
-                    continue
-            except Exception as e:
-                print("Cannot probe device: {} {}".format(item, e))
-                continue
-            try:
-                disk = parted.Disk(device)
-            except Exception as e:
-                print("Cannot probe disk: {} {}".format(item, e))
+        found = list()
+        # Only hand libparted the devices we could actually use
+        for block in self.dm.inventory.get_eligible(MIN_REQUIRED_SIZE):
+            item = self.open_device(block.path)
+            if item:
+                found.append(item)
+        self.drives = self.parse_found(found)
+
+    def open_device(self, path):
+        """ Open a device with libparted, returning (device, disk), or None
+            if it is unusable or holds our own system """
+        disk = None
+        device = None
+        try:
+            device = parted.getDevice(path)
+        except Exception as e:
+            print("Cannot probe device: {} {}".format(path, e))
+            return None
+        try:
+            disk = parted.Disk(device)
+        except Exception as e:
+            print("Cannot probe disk: {} {}".format(path, e))
 
-            # Get a system drive
-            drive = self.dm.parse_system_disk(device, disk, self.mtab)
+        if self.dm.is_boot_disk(device):
+            print("DEBUG: Skipping boot disk")
+            return None
+        return (device, disk)
+
+    def parse_found(self, found):
+        """ Turn a list of (device, disk) into SystemDrives, in the same
+            order """
+        # Probe every partition of every disk in one go
+        partitions = list()
+        for device, disk in found:
+            partitions.extend(self.dm.get_probe_partitions(disk))
+        cache = self.dm.get_probe_cache()
+        prober = PartitionProber(self.dm, self.mtab, cache=cache)
+        probed = prober.probe(partitions)
+        cache.save()
+
+        ret = list()
+        for device, disk in found:
+            drive = self.dm.parse_system_disk(device, disk, self.mtab, probed)
             if drive:
-                self.drives.append(drive)
+                ret.append(drive)
+
+        # Only those with an OS on them are ever candidates for resizing
+        candidates = list()
+        for drive in ret:
+            for path in drive.operating_systems:
+                part = drive.partitions.get(path)
+                if part:
+                    candidates.append(part)
+        self.sizer.submit(candidates)
+        return ret
+
+    def probe_device(self, path):
+        """ Probe a single newly attached drive, without touching the
+            drives we already know about. Returns the SystemDrive, or None
+            if it isn't one we can use """
+        # libparted would otherwise hand back what it saw last time
+        self.forget_device(path)
+
+        self.mtab = self.dm.get_mount_points()
+        block = self.dm.inventory.add(path)
+        if not block or not block.is_eligible(MIN_REQUIRED_SIZE):
+            return None
+        item = self.open_device(block.path)
+        if not item:
+            return None
+        drives = self.parse_found([item])
+        if not drives:
+            return None
+        return drives[0]
+
+    def forget_device(self, path):
+        """ Drop any record of a device that may have changed or gone away
+            from the inventory and libparted's cache """
+        self.dm.inventory.remove(path)
+        try:
+            parted.getDevice(path).removeFromCache()
+        except Exception:
+            pass
+
+    def add_drive(self, drive):
+        """ Add a freshly probed drive, replacing any earlier one at the
+            same path. Returns its index within drives """
+        self.remove_drive(drive.path)
+        index = 0
+        while index < len(self.drives) and \
+                self.drives[index].path < drive.path:
+            index += 1
+        self.drives.insert(index, drive)
+        return index
+
+    def remove_drive(self, path):
+        """ Remove a drive from the set. Returns False if we didn't know
+            about it """
+        drive = self.get_drive(path)
+        if not drive:
+            return False
+        self.drives.remove(drive)
+        return True
 
     def is_broken_windows_uefi(self):
         """ Determine if we booted with UEFI on a MBR Windows system """
@@ -130,6 +431,9 @@ class SystemPartition(GObject.Object):
     # Our parted.Partition reference
     partition = None
 
+    # The DiskManager that found us
+    dm = None
+
     # Our actual path, i.e. /dev/sda3
     path = None
     resizable = False
@@ -150,22 +454,31 @@ class SystemPartition(GObject.Object):
     # Actual size of this partition
     size = None
 
-    # Absolute minimum size as reported by the filesystem
+    # Absolute minimum size as reported by the filesystem. Until
+    # min_size_exact is set, this and resizable are only estimates
     min_size = None
+    min_size_exact = False
+    min_size_lock = None
+
+    # Filesystem label, if it has one
+    label = None
+
+    # Filesystem type as libparted sees it
+    fstype = None
 
     def getLength(self):
         """ Purely for sort compat """
         return self.size
 
-    def build_ntfs_space(self):
-        """ Figure out ntfs minimum size """
+    def get_ntfs_min_size(self):
+        """ Figure out ntfs minimum size, or None if it can't shrink """
         cmd = "LANG=C ntfsresize -im --no-action {}".format(self.path)
 
         try:
             o = subprocess.check_output(cmd, shell=True)
         except Exception as ex:
             print("Cannot resize ntfs: {}".format(ex))
-            return
+            return None
 
         for l in o.split("\n"):
             if ":" not in l:
@@ -173,19 +486,18 @@ class SystemPartition(GObject.Object):
             if "MB" not in l:
                 continue
             min_size = long(l.split(":")[-1].strip())
-            self.min_size = min_size * 1000 * 1000
-            self.resizable = True
-            break
+            return min_size * 1000 * 1000
+        return None
 
-    def build_ext_space(self):
-        """ Figure out ext* min size """
+    def get_ext_min_size(self):
+        """ Figure out ext* min size, or None if it can't shrink """
         cmd = "LANG=C resize2fs -P {}".format(self.path)
 
         try:
             o = subprocess.check_output(cmd, shell=True)
         except Exception as ex:
             print("Cannot resize ext4: {}".format(ex))
-            return
+            return None
 
         for l in o.split("\n"):
             if ":" not in l:
@@ -193,50 +505,115 @@ class SystemPartition(GObject.Object):
             if "minimum size" not in l:
                 continue
             min_size = long(l.split(":")[-1].strip())
-            self.min_size = min_size * 4096 / 1024
+            min_size = min_size * 4096 / 1024
 
             # Handle 1/2k blocks
-            if self.min_size < self.usedspace:
-                self.min_size = self.usedspace
-            self.resizable = True
-            break
-
-    def __init__(self, partition, mount_point, dm):
-        GObject.GObject.__init__(self)
-        self.partition = partition
-        self.path = partition.path
-
-        sectorSize = self.partition.disk.device.sectorSize
-        self.size = self.partition.getLength() * sectorSize
-        self.sizeString = format_size_local(self.size, True)
+            if min_size < self.usedspace:
+                min_size = self.usedspace
+            return min_size
+        return None
 
-        # Get the free space available here
-        try:
-            vfs = os.statvfs(mount_point)
-            self.freespace = vfs.f_bavail * vfs.f_frsize
-            self.totalspace = vfs.f_blocks * vfs.f_frsize
-            self.usedspace = (vfs.f_blocks - vfs.f_bavail) * vfs.f_frsize
-
-            self.freespace_string = format_size_local(self.freespace)
-            self.totalspace_string = format_size_local(self.totalspace)
-            self.usedspace_string = format_size_local(self.usedspace)
-        except Exception as e:
-            print("Failed to stat {}: {}".format(mount_point, e))
+    def can_resize(self):
+        """ Determine if we know how to shrink this filesystem at all """
+        return self.fstype in ["ntfs", "ext2", "ext", "ext3", "ext4"]
 
-        # Now work out if we're resizable.
-        fs = partition.fileSystem
-        if not fs:
+    def estimate_min_size(self):
+        """ Cheap stand-in for the minimum size until resolve_min_size has
+            run, assuming the filesystem can shrink down to its used space """
+        if not self.can_resize():
+            self.min_size_exact = True
             return
-        if fs.type == "ntfs":
+        if self.usedspace is None:
+            return
+        self.min_size = self.usedspace
+        self.resizable = True
+
+    def resolve_min_size(self):
+        """ Replace the estimate with the real minimum size, which means
+            scanning the filesystem as root. Only ever run this on the
+            privileged worker, via a MinSizeCalculator """
+        with self.min_size_lock:
+            if self.min_size_exact:
+                return
+            min_size = None
             try:
-                self.build_ntfs_space()
+                if self.fstype == "ntfs":
+                    min_size = self.get_ntfs_min_size()
+                else:
+                    min_size = self.get_ext_min_size()
             except Exception as e:
-                print("Undefined error in ntfs: {}".format(e))
-        elif fs.type in ["ext2", "ext", "ext3", "ext4"]:
+                print("Undefined error sizing {}: {}".format(self.path, e))
+            if min_size is not None:
+                self.min_size = min_size
+            self.resizable = min_size is not None
+            self.min_size_exact = True
+
+    def get_state(self):
+        """ Everything probed about this partition, for the ProbeCache """
+        return {
+            "freespace": self.freespace,
+            "totalspace": self.totalspace,
+            "min_size": self.min_size,
+            "min_size_exact": self.min_size_exact,
+            "resizable": self.resizable,
+            "label": self.label,
+        }
+
+    def set_state(self, state):
+        """ Restore what get_state returned for an unchanged partition """
+        if state["freespace"] is not None:
+            self.set_space(state["totalspace"], state["freespace"])
+        self.min_size = state["min_size"]
+        self.min_size_exact = state["min_size_exact"]
+        self.resizable = state["resizable"]
+        self.label = state["label"]
+
+    def set_space(self, total, free):
+        """ Record the total and free space, in bytes """
+        self.freespace = free
+        self.totalspace = total
+        self.usedspace = total - free
+
+        self.freespace_string = format_size_local(self.freespace)
+        self.totalspace_string = format_size_local(self.totalspace)
+        self.usedspace_string = format_size_local(self.usedspace)
+
+    def __init__(self, snapshot, mount_point, dm, fsinfo=None,
+                 state=None):
+        """ Built from a PartitionSnapshot, so probe workers need not touch
+            parted. Space comes from the mount point when we have one,
+            otherwise from the FilesystemInfo read off the unmounted
+            device. Given a cached state, nothing is probed at all """
+        GObject.GObject.__init__(self)
+        self.dm = dm
+        self.partition = snapshot.partition
+        self.path = snapshot.path
+        self.min_size_lock = threading.Lock()
+        self.fstype = snapshot.fstype
+        self.size = snapshot.size
+        self.sizeString = format_size_local(self.size, True)
+
+        if state:
+            self.set_state(state)
+            return
+
+        if fsinfo:
+            self.label = fsinfo.label
+
+        # Get the free space available here
+        if mount_point:
             try:
-                self.build_ext_space()
+                vfs = os.statvfs(mount_point)
+                self.set_space(vfs.f_blocks * vfs.f_frsize,
+                               vfs.f_bavail * vfs.f_frsize)
             except Exception as e:
-                print("Undefined error in ext*: {}".format(e))
+                print("Failed to stat {}: {}".format(mount_point, e))
+        elif fsinfo and fsinfo.free is not None:
+            self.set_space(fsinfo.size, fsinfo.free)
+
+        # The real figure means scanning the filesystem, so leave that for
+        # a MinSizeCalculator or whoever first needs it
+        self.estimate_min_size()
 
 
 class SystemDrive:
@@ -272,6 +649,9 @@ class SystemDrive:
     # Encapsulated partitions
     partitions = None
 
+    # The BlockDevice sysfs snapshot, if we have one
+    block = None
+
     def __init__(self, device, disk, vendor, model, sizeString, ops):
         self.device = device
         self.disk = disk
@@ -309,6 +689,12 @@ class SystemDrive:
             return self.disk.type
         return None
 
+    def get_alignment(self):
+        """ Bytes that new partitions should be aligned to """
+        if self.block:
+            return self.block.get_alignment()
+        return MIN_ALIGNMENT
+
 
 class OsType:
     """ OS detection code ensuring we don't lose information """
@@ -330,18 +716,25 @@ class OsType:
         self.name = name
         self.device_path = device_path
 
+    def get_state(self):
+        """ What we detected, for the ProbeCache """
+        return {
+            "otype": self.otype,
+            "name": self.name,
+            "icon_name": self.icon_name,
+        }
+
 
 class DiskManager:
     """ Manage all disk operations """
 
-    re_whole_disk = None
-    re_mmcblk = None
-    re_nvme = None
-    re_raid = None
+    # Snapshot of the whole disks, and their device nodes
+    inventory = None
     devices = None
 
     win_prefixes = None
     win_bootloaders = None
+    bcd_scanner = None
 
     is_uefi = False
     uefi_fw_size = 64
@@ -350,16 +743,21 @@ class DiskManager:
 
     os_icons = None
 
-    def __init__(self):
-        # Gratefully borrowed from gparted, Proc_Partitions_Info.cc
-        self.re_whole_disk = re.compile(
-            "^[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+([^0-9]+)$")
-        self.re_mmcblk = re.compile(
-            "^[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+(mmcblk[0-9]+)$")
-        self.re_nvme = re.compile(
-            "^[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+(nvme[0-9]+n[0-9]+)$")
-        self.re_raid = re.compile(
-            "^[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+[0-9]+[\t ]+(md[0-9]+)$")
+    # Partition probe results, shared by every DriveProber
+    probe_cache = None
+
+    # Tears down whatever we mount
+    mounts = None
+
+    # Runs everything needing root while the installer is interactive,
+    # and the background work of sizing partitions on it
+    worker = None
+    sizer = None
+
+    def __init__(self, perms):
+        self.mounts = MountManager()
+        self.worker = PrivilegedWorker(perms)
+        self.sizer = MinSizeCalculator(self)
 
         # Rough versioning matches for Windows
         self.win_prefixes = {
@@ -377,15 +775,16 @@ class DiskManager:
             "4.0.950": "Windows 95",
         }
 
-        # Rough match for BCD
-        self.win_bootloaders = {
-            "V.i.s.t.a": "Windows Vista bootloader",
-            "W.i.n.d.o.w.s. .7": "Windows 7 bootloader",
-            "W.i.n.d.o.w.s. .R.e.c.o.v.e.r.y. .E.n.v.i.r.o.n.m.e.n.t":
-                "Windows recovery",
-            "W.i.n.d.o.w.s. .S.e.r.v.e.r. .2.0.0.8":
-                "Windows Server 2008 bootloader"
-        }
+        # Rough match for BCD, in order of preference
+        self.win_bootloaders = [
+            ("Vista", "Windows Vista bootloader"),
+            ("Windows 7", "Windows 7 bootloader"),
+            ("Windows Server 2008", "Windows Server 2008 bootloader"),
+            ("Windows Recovery Environment", "Windows recovery"),
+        ]
+        self.bcd_scanner = SignatureScanner(
+            [(name, utf16_signature(key))
+             for key, name in self.win_bootloaders])
 
         # Set up UEFI knowledge
         if os.path.exists("/sys/firmware/efi"):
@@ -419,6 +818,35 @@ class DiskManager:
             "ubuntu-mate", "ubuntu"
         ]
 
+    def get_probe_cache(self):
+        """ Return the ProbeCache, loading it on first use """
+        if not self.probe_cache:
+            self.probe_cache = ProbeCache()
+            self.probe_cache.load()
+        return self.probe_cache
+
+    def get_probe_state(self, result):
+        """ Turn the result of probing a partition into cacheable state """
+        part, os_type = result
+        return {
+            "partition": part.get_state() if part else None,
+            "os": os_type.get_state() if os_type else None,
+        }
+
+    def restore_probe_result(self, partition, state):
+        """ Rebuild the result of probing a partition from cached state """
+        part = None
+        os_type = None
+        if state["partition"]:
+            part = SystemPartition(partition, None, self,
+                                   state=state["partition"])
+        if state["os"]:
+            os_state = state["os"]
+            os_type = OsType(os_state["otype"], os_state["name"],
+                             partition.partition)
+            os_type.icon_name = os_state["icon_name"]
+        return (part, os_type)
+
     def is_efi_system_partition(self, partition):
         """ Is the given partition an EFI System Partition (ESP) ? """
         disk = partition.disk
@@ -439,63 +867,27 @@ class DiskManager:
         return True
 
     def scan_parts(self):
-        self.devices = []
-        try:
-            part_file = open("/proc/partitions")
-        except Exception as ex:
-            print("Failed to scan parts: {}".format(ex))
-            return
-
-        groups = [self.re_whole_disk,
-                  self.re_mmcblk,
-                  self.re_nvme,
-                  self.re_raid]
-
-        for line in part_file.readlines():
-            # readlines doesn't consume
-            line = line.replace("\r", "").replace("\n", "")
-
-            for x in groups:
-                m = x.match(line)
-                if not m:
-                    continue
-                self.push_device(m.group(1))
-                break
-
-        part_file.close()
-
-    def push_device(self, device):
-        """ Push a newly discovered device into the list """
-        fpath = "/dev/{}".format(str(device))
-        if not os.path.exists(fpath):
-            print("Debug: Non-existent node: {}".format(fpath))
-            return
-        fpath = os.path.realpath(fpath)
-        if device not in self.devices:
-            self.devices.append(fpath)
+        """ Take a fresh snapshot of the whole disks on the system """
+        self.inventory = BlockInventory()
+        self.inventory.scan()
+        self.devices = list(self.inventory.devices.keys())
+
+    def get_block_device(self, path):
+        """ Return the BlockDevice for a node, from the inventory if it has
+            one, otherwise straight from sysfs """
+        if self.inventory:
+            block = self.inventory.get(path)
+            if block:
+                return block
+        return get_block_device(path)
 
     @staticmethod
     def is_device_ssd(path):
         """ Determine if the device is an SSD """
-        nodename = os.path.basename(path)
-        fpath = "/sys/block/{}/queue/rotational".format(nodename)
-        if not os.path.exists(fpath):
-            return False
-
-        # Don't try using SSD trim with eMMC
-        if nodename.startswith("mmcblk"):
+        block = get_block_device(path)
+        if not block:
             return False
-
-        try:
-            with open(fpath, "r") as inp_file:
-                items = inp_file.readlines()
-                if len(items) == 1:
-                    line = items[0].replace("\n", "").replace("\r", "")
-                    if line == "0":
-                        return True
-        except Exception:
-            pass
-        return False
+        return block.is_ssd()
 
     def is_install_supported(self, path):
         """ Currently we only support rootfs installs on certain types... """
@@ -505,27 +897,9 @@ class DiskManager:
         return True
 
     def get_mount_points(self):
-        """ Return a mapping of device to mountpoint """
-        ret = dict()
-
-        with open("/proc/self/mounts", "r") as mpoints:
-            for line in mpoints.readlines():
-                line = line.replace("\n", "").replace("\r", "").strip()
-
-                if line == "":
-                    continue
-                splits = line.split()
-                if len(splits) < 4:
-                    continue
-                dev = splits[0]
-                mpoint = splits[1]
-
-                # Only interested in block devices
-                if dev[0] != '/':
-                    continue
-
-                ret[os.path.abspath(os.path.realpath(dev))] = mpoint
-        return ret
+        """ Return a mapping of device to mountpoint, shared with everyone
+            else until the mounts change, so don't modify it """
+        return self.mounts.get_table().mount_points
 
     def do_mount(self, device, mpoint, fsystem, options=None):
         """ Try to mount the device at mount_point """
@@ -542,30 +916,8 @@ class DiskManager:
         return True
 
     def do_umount(self, thing):
-        """ umount the given mountpoint/device """
-        umount_cmd = "umount \"{}\"".format(thing)
-        try_count = 0
-
-        while (try_count < 3):
-            try_count += 1
-            try:
-                subprocess.check_call(umount_cmd, shell=True)
-                return True
-            except Exception:
-                # wait 500ms, try again
-                time.sleep(0.5)
-                continue
-
-        umount_cmd = "umount -l \"{}\"".format(thing)
-        try:
-            subprocess.check_call(umount_cmd)
-            return True
-        except Exception as e:
-            print("Failed to unmount {}: {}".format(thing, e))
-            return False
-
-        # Finally umounted with lazy.
-        return True
+        """ umount the given mountpoint/device, and anything beneath it """
+        return self.mounts.unmount(thing)
 
     def get_windows_version(self, path):
         """ Attempt to gain the Windows version """
@@ -602,44 +954,72 @@ class DiskManager:
         if not os.path.exists(fpath):
             return None
 
-        for key in self.win_bootloaders:
-            cmd = "grep -qs \"{}\" \"{}\"".format(key, fpath)
-            try:
-                subprocess.check_call(cmd)
-                return self.win_bootloaders[key]
-            except Exception:
-                continue
+        try:
+            name = self.bcd_scanner.match(fpath)
+            if name:
+                return name
+        except Exception as e:
+            print("Cannot scan {}: {}".format(fpath, e))
 
         return "Windows bootloader"
 
-    def extract_os_release_key(self, path, find_key):
-        """ Grab a key from the given os-release file """
-        with open(path, "r") as inp_file:
-            for line in inp_file.readlines():
-                line = line.replace("\r", "").replace("\n", "").strip()
-                if line == "":
-                    continue
+    def extract_os_release_key(self, lines, find_key):
+        """ Grab a key from the lines of an os-release file """
+        for line in lines:
+            line = line.replace("\r", "").replace("\n", "").strip()
+            if line == "":
+                continue
 
-                if "=" not in line:
-                    continue
-                splits = line.split("=")
-                key = splits[0].lower()
-                val = "=".join(splits[1:]).strip()
+            if "=" not in line:
+                continue
+            splits = line.split("=")
+            key = splits[0].lower()
+            val = "=".join(splits[1:]).strip()
 
-                if len(val) == 0:
-                    continue
-                if val[0] == "\"":
-                    val = val[1:]
-                if val[-1] == "\"":
-                    val = val[0:-1]
+            if len(val) == 0:
+                continue
+            if val[0] == "\"":
+                val = val[1:]
+            if val[-1] == "\"":
+                val = val[0:-1]
 
-                if key != find_key.lower():
-                    continue
-                return val
+            if key != find_key.lower():
+                continue
+            return val
         return None
 
-    def get_linux_version(self, path):
-        """ Attempt to get the Linux version string """
+    def read_mounted_file(self, root, item):
+        """ Return the lines of a file beneath root, or None if missing """
+        fpath = os.path.join(root, item)
+        if not os.path.exists(fpath):
+            return None
+        with open(fpath, "r") as inp_file:
+            return inp_file.readlines()
+
+    def read_ext_file(self, device, item):
+        """ Return the lines of a file within an unmounted ext* filesystem,
+            or None if missing. debugfs reads it in place, read-only """
+        cmd = ["debugfs", "-c", "-R", "cat \"/{}\"".format(item), device]
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        except Exception as e:
+            print("Cannot read {} from {}: {}".format(item, device, e))
+            return None
+        # Missing files only show up as complaints on stderr
+        if p.returncode != 0 or not out:
+            return None
+        return out.splitlines()
+
+    def get_linux_version(self, path, read_file=None):
+        """ Attempt to get the Linux version string. read_file returns the
+            lines of a file relative to the root, or None, and defaults to
+            reading beneath the mount point path """
+        if not read_file:
+            def read_file(item):
+                return self.read_mounted_file(path, item)
+
         # os-release files, with stateless support
         os_paths = [
             "etc/os-release",
@@ -661,13 +1041,13 @@ class DiskManager:
         # respecting stateless heirarchy
         for key_main, key_fallback, paths in key_checks:
             for item in paths:
-                fpath = os.path.join(path, item)
-                if not os.path.exists(fpath):
+                lines = read_file(item)
+                if not lines:
                     continue
 
-                pname = self.extract_os_release_key(fpath, key_main)
+                pname = self.extract_os_release_key(lines, key_main)
                 if not pname:
-                    pname = self.extract_os_release_key(fpath, key_fallback)
+                    pname = self.extract_os_release_key(lines, key_fallback)
                 if not pname:
                     continue
                 return pname
@@ -700,17 +1080,36 @@ class DiskManager:
             return None
 
     def detect_operating_system_and_space(self, device, mpoints):
-        """ Determine the operating system and space for a given device """
+        """ Determine the operating system and space for a given device,
+            described by a PartitionSnapshot """
         mounted = False
         mount_point = None
 
         path = device.path
 
-        fs = device.fileSystem
         # unmountables
-        if fs and fs.type in [None, "linux-swap(v1)", "linux-swap(v0)"]:
+        if device.has_filesystem and \
+                device.fstype in [None, "linux-swap(v1)", "linux-swap(v0)"]:
             return (None, None)
 
+        # Space and labels come straight off the superblock
+        fsinfo = None
+        try:
+            fsinfo = read_filesystem_info(path)
+        except Exception as e:
+            print("Cannot read superblock of {}: {}".format(path, e))
+
+        # ext* contents can be read in place too, no mount needed at all
+        if path not in mpoints and fsinfo and fsinfo.is_ext() and \
+                fsinfo.free is not None:
+            ret = None
+            dname = self.get_linux_version(
+                None, lambda item: self.read_ext_file(path, item))
+            if dname:
+                ret = OsType("linux", dname, device.partition)
+                ret.icon_name = self.get_os_icon(ret)
+            return (SystemPartition(device, None, self, fsinfo), ret)
+
         # Mount it if not already mounted
         if path not in mpoints:
             mount_point = self.create_temp_dir()
@@ -722,6 +1121,9 @@ class DiskManager:
                     os.rmdir(mount_point)
                 except Exception as e:
                     print("Failed to remove stagnant directory: {}".format(e))
+                # Not much to go on, but still better than nothing
+                if fsinfo:
+                    return (SystemPartition(device, None, self, fsinfo), None)
                 return (None, None)
             mounted = True
         else:
@@ -739,11 +1141,11 @@ class DiskManager:
         for os_type, vfunc in possibles:
             dname = vfunc(mount_point)
             if dname:
-                ret = OsType(os_type, dname, device)
+                ret = OsType(os_type, dname, device.partition)
                 ret.icon_name = self.get_os_icon(ret)
                 break
 
-        part = SystemPartition(device, mount_point, self)
+        part = SystemPartition(device, mount_point, self, fsinfo)
         # Unmount again
         if mounted:
             if self.do_umount(mount_point):
@@ -763,21 +1165,17 @@ class DiskManager:
 
     def get_disk_model(self, device):
         """ Get the model of the device """
-        node = os.path.basename(device)
-        fpath = "/sys/block/{}/device/model".format(node)
-
-        if not os.path.exists(fpath):
+        block = self.get_block_device(device)
+        if not block:
             return None
-        return self._read_line_complete(fpath)
+        return block.model
 
     def get_disk_vendor(self, device):
         """ Get the vendor for the device """
-        node = os.path.basename(device)
-        fpath = "/sys/block/{}/device/vendor".format(node)
-
-        if not os.path.exists(fpath):
+        block = self.get_block_device(device)
+        if not block:
             return None
-        return self._read_line_complete(fpath)
+        return block.vendor
 
     def get_disk_size_bytes(self, device):
         """ Return byte length of disk (parted.Device) """
@@ -795,38 +1193,36 @@ class DiskManager:
         """ 64-bit or 32-bit firmware """
         return self.uefi_fw_size
 
-    def parse_system_disk(self, device, disk, mpoints):
-        """ Parse a given parted.Disk into a SystemDevice """
+    def is_boot_disk(self, device):
+        """ Determine if this disk holds our own root or live media """
+        return self.mounts.get_table().is_system_device(device.path)
+
+    def get_probe_partitions(self, disk):
+        """ Get the partitions of a disk worth probing """
+        if not disk:
+            return []
+        return [x for x in disk.partitions if x.fileSystem]
+
+    def parse_system_disk(self, device, disk, mpoints, probed=None):
+        """ Parse a given parted.Disk into a SystemDevice, optionally using
+            the results of an earlier PartitionProber run """
         operating_systems = dict()
         list_esp = list()
         partitions = dict()
 
-        blacklist = []
-
-        for mpoint in mpoints:
-            whence = mpoints[mpoint]
-            if whence == "/" or whence.startswith("/run/initramfs"):
-                blacklist.append(mpoint)
-
-        # i.e. /dev/sda, full write mount
-        if device.path in blacklist:
+        if self.is_boot_disk(device):
             print("DEBUG: Skipping boot disk")
             return None
 
+        if probed is None:
+            prober = PartitionProber(self, mpoints)
+            probed = prober.probe(self.get_probe_partitions(disk))
+
         # Could be a disk without a label
         if disk:
-            # i.e. /dev/sda1, partition mount
-            for partition in disk.partitions:
-                if partition.path in blacklist:
-                    print("DEBUG: Skipping boot disk")
-                    return None
-
-                if not partition.fileSystem:
-                    continue
-
-                (part, os) = self.detect_operating_system_and_space(partition,
-                                                                    mpoints)
-                if self.is_efi_system_partition(partition):
+            for partition in self.get_probe_partitions(disk):
+                (part, os) = probed.get(partition.path, (None, None))
+                if part and self.is_efi_system_partition(partition):
                     list_esp.append(part)
                 partitions[partition.path] = part
                 if not os:
@@ -838,6 +1234,7 @@ class DiskManager:
         vendor = self.get_disk_vendor(device.path)
         model = self.get_disk_model(device.path)
         r = SystemDrive(device, disk, vendor, model, sz, operating_systems)
+        r.block = self.get_block_device(device.path)
         # Cache ESP
         r.list_esp = list_esp
         r.list_esp.sort(key=SystemPartition.getLength, reverse=True)
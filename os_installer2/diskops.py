@@ -12,6 +12,7 @@
 #
 
 from os_installer2 import format_size_local
+from .mkfs import FormatProfile
 import parted
 import subprocess
 import tempfile
@@ -35,6 +36,14 @@ class BaseDiskOp:
     part_offset = 0
     disk = None
 
+    # Whether formatting lays down the root filesystem, which the install
+    # may instead write wholesale from the live image
+    formats_root = False
+
+    # Number of files about to be installed, set by the installer on ops
+    # that format root
+    payload_files = None
+
     def __init__(self, device):
         self.device = device
 
@@ -59,6 +68,23 @@ class BaseDiskOp:
         """ Useful only for new partitions """
         self.part_offset = newoffset
 
+    def depends_on(self, op):
+        """ Determine if apply_format must wait for the given (earlier)
+            operation to finish formatting first """
+        return False
+
+    def format_ext4(self, path, is_root=False):
+        """ Format path as ext4 with options suited to what it lives on.
+            The root filesystem has its inodes sized from the payload """
+        payload = self.payload_files if is_root else None
+        cmd = FormatProfile(path).get_ext4_command(payload)
+        try:
+            subprocess.check_call(cmd, shell=True)
+        except Exception as e:
+            self.set_errors("{}: {}".format(path, e))
+            return False
+        return True
+
 
 class DiskOpCreateDisk(BaseDiskOp):
     """ Create a new parted.Disk """
@@ -256,18 +282,14 @@ class DiskOpCreateBoot(DiskOpCreatePartition):
         return True
 
     def apply_format(self, disk):
-        cmd = "mkfs.ext4 -F {}".format(self.part.path)
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            self.set_errors("{}: {}".format(self.part.path, e))
-            return False
-        return True
+        return self.format_ext4(self.part.path)
 
 
 class DiskOpCreateRoot(DiskOpCreatePartition):
     """ Create a new root partition """
 
+    formats_root = True
+
     def __init__(self, device, ptype, size):
         DiskOpCreatePartition.__init__(
             self,
@@ -281,13 +303,7 @@ class DiskOpCreateRoot(DiskOpCreatePartition):
             format_size_local(self.size, True), self.device.path)
 
     def apply_format(self, disk):
-        cmd = "mkfs.ext4 -F {}".format(self.part.path)
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            self.set_errors("{}: {}".format(self.part.path, e))
-            return False
-        return True
+        return self.format_ext4(self.part.path, True)
 
     def apply(self, disk, simulate):
         """ Create root partition  """
@@ -433,6 +449,9 @@ class DiskOpCreateLUKSPhysicalVolume(BaseDiskOp):
     def describe(self):
         return "Create physical volume on {}".format(self.luks_op.mapper_name)
 
+    def depends_on(self, op):
+        return op is self.luks_op
+
     def apply_format(self, disk):
         fpath = self.luks_op.mapper_name
         cmd = "/sbin/pvcreate -ff -y {}".format(fpath)
@@ -484,6 +503,9 @@ class DiskOpCreateVolumeGroup(BaseDiskOp):
         return "Create volume group '{}' on {}".format(
             self.vg_name, self.device.path)
 
+    def depends_on(self, op):
+        return op is self.pv_op
+
 
 class DiskOpCreateLogicalVolume(BaseDiskOp):
     """ Create a Logical Volume within the given VolumeGroup """
@@ -526,6 +548,14 @@ class DiskOpCreateLogicalVolume(BaseDiskOp):
         return "Create logical volume '{}' on group '{}'".format(
             self.lv_name, self.vg_name)
 
+    def depends_on(self, op):
+        """ Needs the group, and any volumes before us, as we may be taking
+            whatever space they leave """
+        if isinstance(op, (DiskOpCreateVolumeGroup,
+                           DiskOpCreateLogicalVolume)):
+            return op.vg_name == self.vg_name
+        return False
+
 
 class DiskOpUseSwap(BaseDiskOp):
     """ Use an existing swap paritition """
@@ -690,10 +720,20 @@ class DiskOpFormatPartition(BaseDiskOp):
     def describe(self):
         return "Format {} as {}".format(self.part.path, self.format_type)
 
+    def depends_on(self, op):
+        """ Formatting waits on whatever creates the device """
+        if isinstance(op, DiskOpCreateLogicalVolume):
+            return op.path == self.part.path
+        if isinstance(op, DiskOpCreatePartition) and op.part:
+            return op.part.path == self.part.path
+        return False
+
 
 class DiskOpFormatRoot(DiskOpFormatPartition):
     """ Format the root partition """
 
+    formats_root = True
+
     def __init__(self, device, part):
         DiskOpFormatPartition.__init__(self, device, part, "ext4")
 
@@ -705,18 +745,14 @@ class DiskOpFormatRoot(DiskOpFormatPartition):
         if simulate:
             return True
 
-        cmd = "mkfs.ext4 -F {}".format(self.part.path)
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            self.set_errors("{}: {}".format(self.part.path, e))
-            return False
-        return True
+        return self.format_ext4(self.part.path, True)
 
 
 class DiskOpFormatRootLate(DiskOpFormatPartition):
     """ Format the root partition """
 
+    formats_root = True
+
     def __init__(self, device, part):
         DiskOpFormatPartition.__init__(self, device, part, "ext4")
 
@@ -728,13 +764,7 @@ class DiskOpFormatRootLate(DiskOpFormatPartition):
         return True
 
     def apply_format(self, disk):
-        cmd = "mkfs.ext4 -F {}".format(self.part.path)
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            self.set_errors("{}: {}".format(self.part.path, e))
-            return False
-        return True
+        return self.format_ext4(self.part.path, True)
 
 
 class DiskOpFormatSwap(DiskOpFormatPartition):
@@ -797,13 +827,7 @@ class DiskOpFormatHome(DiskOpFormatPartition):
         if simulate:
             return True
 
-        cmd = "mkfs.ext4 -F {}".format(self.part.path)
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            self.set_errors("{}: {}".format(self.part.path, e))
-            return False
-        return True
+        return self.format_ext4(self.part.path)
 
 
 class DiskOpUseHome(BaseDiskOp):
@@ -0,0 +1,148 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from .blockdev import is_whole_disk
+import os
+import select
+import socket
+import struct
+import threading
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Multicast group udevd rebroadcasts events on, once its rules have run and
+# the device nodes exist. The kernel's own group (1) races node creation
+UDEV_MONITOR_GROUP = 2
+
+# struct udev_monitor_netlink_header, as sent by libudev
+UDEV_PREFIX = b"libudev\0"
+UDEV_MAGIC = 0xfeedcafe
+UDEV_HEADER = "=8sIIII"
+
+RECV_SIZE = 16 * 1024
+
+
+def parse_udev_event(data):
+    """ Decode a libudev netlink message into a dict of its properties, or
+        None if the message isn't one """
+    if len(data) < struct.calcsize(UDEV_HEADER):
+        return None
+    prefix, magic, header_size, off, length = \
+        struct.unpack_from(UDEV_HEADER, data)
+    if prefix != UDEV_PREFIX or socket.ntohl(magic) != UDEV_MAGIC:
+        return None
+    if off < header_size or off + length > len(data):
+        return None
+    props = dict()
+    for item in data[off:off + length].split(b"\0"):
+        if b"=" not in item:
+            continue
+        key, value = item.split(b"=", 1)
+        props[key.decode("utf-8", "replace")] = \
+            value.decode("utf-8", "replace")
+    return props
+
+
+class HotplugMonitor:
+    """ Listen for whole disks being attached or detached.
+
+        Events are only ever a hint to go and look at the device again, so
+        we don't need to verify where they came from. The callback is
+        invoked from the monitor thread as callback(action, path), where
+        action is one of "add" or "remove". """
+
+    callback = None
+
+    sock = None
+    thread = None
+
+    # Written to in order to wake the thread up for stopping
+    wake_r = None
+    wake_w = None
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def start(self):
+        """ Begin listening. Returns False if we can't """
+        if self.thread:
+            return True
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                      NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, UDEV_MONITOR_GROUP))
+        except Exception as e:
+            print("Cannot monitor hotplug events: {}".format(e))
+            self.sock = None
+            return False
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """ Stop listening, and wait for the thread to finish """
+        if not self.thread:
+            return
+        os.write(self.wake_w, b"\0")
+        self.thread.join()
+        self.thread = None
+        self.sock.close()
+        self.sock = None
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def run(self):
+        """ Monitor thread """
+        while True:
+            try:
+                ready, _, _ = select.select([self.sock, self.wake_r], [], [])
+            except select.error:
+                continue
+            if self.wake_r in ready:
+                return
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except socket.error as e:
+                # ENOBUFS means we lost some events, carry on regardless
+                print("Hotplug monitor: {}".format(e))
+                continue
+            props = parse_udev_event(data)
+            if props:
+                self.handle(props)
+
+    def handle(self, props):
+        """ Pass on the events we care about """
+        if props.get("SUBSYSTEM") != "block":
+            return
+        if props.get("DEVTYPE") != "disk":
+            return
+        path = props.get("DEVNAME")
+        if not path:
+            return
+        path = "/dev/{}".format(os.path.basename(path))
+        action = props.get("ACTION")
+        if action == "change":
+            # udev synthesises a change each time a disk we opened for
+            # writing is closed, as libparted does when probing. Only
+            # media change (i.e. card readers) is a real add
+            if props.get("DISK_MEDIA_CHANGE") != "1":
+                return
+            action = "add"
+        elif action not in ["add", "remove"]:
+            return
+        # sysfs is gone by the time we hear of a removal
+        if action == "add" and not is_whole_disk(os.path.basename(path)):
+            return
+        self.callback(action, path)
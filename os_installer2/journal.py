@@ -0,0 +1,219 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from .diskops import DummyPart
+import hashlib
+import json
+import os
+import parted
+
+# Where the journal lives while the installer runs (tmpfs)
+JOURNAL_PATH = "/run/os-installer/journal.json"
+
+# Where the journal is mirrored within the target root, once mounted
+JOURNAL_MIRROR = "var/log/os-installer-journal.json"
+
+# Bump whenever the journal layout changes incompatibly
+JOURNAL_VERSION = 1
+
+# Operation attributes that only become known while applying an operation,
+# and which later stages rely upon
+OPERATION_STATE = ["crypto_uuid"]
+
+
+def get_plan_fingerprint(strategy):
+    """ Identify an installation plan by everything it will do to disk """
+    plan = [strategy.get_name()]
+    if strategy.device:
+        plan.append(strategy.device.path)
+    plan.extend([op.describe() for op in strategy.get_operations()])
+    plan = "\n".join(plan)
+    if not isinstance(plan, bytes):
+        plan = plan.encode("utf-8")
+    return hashlib.sha1(plan).hexdigest()
+
+
+def get_disk_layout(disk):
+    """ Summarise a partition table for later comparison """
+    if not disk:
+        return []
+    return [[p.path, p.geometry.start, p.geometry.length]
+            for p in disk.partitions]
+
+
+def get_operation_state(op):
+    """ Capture whatever an applied operation learned about the disk """
+    state = dict()
+    part = getattr(op, "part", None)
+    if part is not None and part.path:
+        state["part"] = part.path
+    for key in OPERATION_STATE:
+        value = getattr(op, key, None)
+        if value is not None:
+            state[key] = value
+    return state
+
+
+def restore_operation_state(op, state):
+    """ Give an operation back what it learned during an earlier run """
+    if "part" in state and getattr(op, "part", None) is None:
+        op.part = DummyPart(state["part"])
+    for key in OPERATION_STATE:
+        if key in state:
+            setattr(op, key, state[key])
+
+
+class InstallJournal:
+    """ Persistent record of how far an installation got.
+
+        Each completed stage (partitioning, every format operation, the
+        image stream or file copy, and each post-install step) is recorded
+        as a named checkpoint. The journal is kept on tmpfs so it survives
+        the installer exiting, and mirrored into the target root once that
+        is mounted so the record travels with the disk it describes. A
+        later attempt with the very same plan may then skip whatever has
+        already been done. """
+
+    # Journal location, and the mirror within the target if mounted
+    path = None
+    mirror = None
+
+    # Fingerprint of the plan this journal belongs to
+    plan = None
+
+    # Completed checkpoints, in order
+    steps = None
+
+    # Per-operation state after partitioning, and the resulting layout
+    operations = None
+    layout = None
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.steps = []
+        self.operations = []
+        self.layout = []
+
+    def reset(self, plan):
+        """ Start a fresh journal for the given plan """
+        self.plan = plan
+        self.steps = []
+        self.operations = []
+        self.layout = []
+        self.save()
+
+    def load(self, plan):
+        """ Adopt the existing journal if it matches the plan, otherwise
+            start afresh. Returns True if there is anything to resume """
+        try:
+            with open(self.path, "r") as inp:
+                data = json.load(inp)
+            if data.get("version") != JOURNAL_VERSION:
+                raise ValueError("unknown version")
+            if data.get("plan") != plan:
+                raise ValueError("different installation plan")
+            self.plan = plan
+            self.steps = data["steps"]
+            self.operations = data["operations"]
+            self.layout = data["layout"]
+        except Exception as e:
+            if os.path.exists(self.path):
+                print("Not resuming from journal: {}".format(e))
+            self.reset(plan)
+            return False
+
+        print("Resuming installation after: {}".format(
+            ", ".join(self.steps)))
+        return len(self.steps) > 0
+
+    def write_file(self, path, data):
+        """ Atomically and durably replace path with data """
+        tmp = "{}.tmp".format(path)
+        with open(tmp, "w") as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmp, path)
+
+    def save(self):
+        """ Write the journal out, and to the mirror if we have one """
+        data = json.dumps({
+            "version": JOURNAL_VERSION,
+            "plan": self.plan,
+            "steps": self.steps,
+            "operations": self.operations,
+            "layout": self.layout,
+        }, indent=1)
+        for path in [self.path, self.mirror]:
+            if not path:
+                continue
+            try:
+                dirname = os.path.dirname(path)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname, 0o0755)
+                self.write_file(path, data)
+            except Exception as e:
+                # Only costs us the ability to resume, never the install
+                print("Cannot write journal {}: {}".format(path, e))
+
+    def set_mirror(self, root):
+        """ Mirror the journal into the newly mounted target root """
+        self.mirror = os.path.join(root, JOURNAL_MIRROR)
+        self.save()
+
+    def is_done(self, step):
+        """ Determine if the given checkpoint has been reached """
+        return step in self.steps
+
+    def mark(self, step):
+        """ Record a completed checkpoint """
+        if step not in self.steps:
+            self.steps.append(step)
+        self.save()
+
+    def record_operations(self, ops, disk=None):
+        """ Remember what the applied operations resolved to, and the
+            partition table they left behind """
+        self.operations = [get_operation_state(op) for op in ops]
+        if disk:
+            self.layout = get_disk_layout(disk)
+
+    def restore_operations(self, ops, device):
+        """ Restore operation state from the journal, provided the disk still
+            looks exactly as we left it. Returns False if it does not """
+        if len(ops) != len(self.operations):
+            return False
+        if self.layout:
+            try:
+                current = get_disk_layout(parted.newDisk(device))
+            except Exception as e:
+                print("Cannot read partition table: {}".format(e))
+                return False
+            if current != self.layout:
+                return False
+        for state in self.operations:
+            if "part" in state and not os.path.exists(state["part"]):
+                return False
+        for op, state in zip(ops, self.operations):
+            restore_operation_state(op, state)
+        return True
+
+    def discard(self):
+        """ The installation is complete, nothing is left to resume """
+        for path in [self.path, self.mirror]:
+            if path and os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except Exception as e:
+                    print("Cannot remove journal {}: {}".format(path, e))
+        self.steps = []
@@ -0,0 +1,225 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from .blockdev import SYSFS_BLOCK, get_backing_devices
+from collections import OrderedDict
+import json
+import os
+import subprocess
+
+LVM_BINARY = "/sbin/lvm"
+
+# A PV label lives at the start of one of the first four sectors
+LVM_LABEL_SECTORS = 4
+LVM_SECTOR_SIZE = 512
+LVM_LABEL_ID = b"LABELONE"
+LVM_LABEL_TYPE = b"LVM2 001"
+LVM_LABEL_TYPE_OFFSET = 24
+
+
+def has_pv_label(path):
+    """ Determine if the device at path carries an LVM2 PV label """
+    try:
+        with open(path, "rb") as inp:
+            buf = inp.read(LVM_LABEL_SECTORS * LVM_SECTOR_SIZE)
+    except Exception:
+        return False
+    for sector in range(LVM_LABEL_SECTORS):
+        off = sector * LVM_SECTOR_SIZE
+        if buf[off:off + len(LVM_LABEL_ID)] != LVM_LABEL_ID:
+            continue
+        off += LVM_LABEL_TYPE_OFFSET
+        if buf[off:off + len(LVM_LABEL_TYPE)] == LVM_LABEL_TYPE:
+            return True
+    return False
+
+
+def get_partition_names(name, root=SYSFS_BLOCK):
+    """ Names of the partitions on the named disk, from sysfs """
+    base = os.path.join(root, name)
+    try:
+        children = os.listdir(base)
+    except OSError:
+        return []
+    return sorted(x for x in children
+                  if os.path.exists(os.path.join(base, x, "partition")))
+
+
+def find_physical_volumes(devices, root=SYSFS_BLOCK):
+    """ Device nodes among the given BlockDevices, or their partitions,
+        that carry a PV label """
+    ret = []
+    for device in devices:
+        names = [device.name] + get_partition_names(device.name, root)
+        for name in names:
+            path = "/dev/{}".format(name)
+            if has_pv_label(path):
+                ret.append(path)
+    return ret
+
+
+def get_report_int(item, key):
+    """ Sizes come back as strings of bytes, possibly empty """
+    try:
+        return int(item.get(key, ""))
+    except ValueError:
+        return 0
+
+
+class PhysicalVolume:
+    """ An LVM2 physical volume """
+
+    path = None
+    uuid = None
+
+    # Owning VolumeGroup name, or None for an orphan
+    vg_name = None
+
+    # In bytes
+    size = 0
+    free = 0
+
+    def __init__(self, item, vg_name):
+        self.path = item.get("pv_name")
+        self.uuid = item.get("pv_uuid")
+        self.vg_name = vg_name or None
+        self.size = get_report_int(item, "pv_size")
+        self.free = get_report_int(item, "pv_free")
+
+
+class LogicalVolume:
+    """ An LVM2 logical volume """
+
+    name = None
+    vg_name = None
+    uuid = None
+
+    # i.e. /dev/SolusSystem/Root
+    path = None
+
+    # In bytes
+    size = 0
+
+    active = False
+
+    def __init__(self, item, vg_name):
+        self.name = item.get("lv_name")
+        self.vg_name = vg_name
+        self.uuid = item.get("lv_uuid")
+        self.path = item.get("lv_path") or "/dev/{}/{}".format(
+            vg_name, self.name)
+        self.size = get_report_int(item, "lv_size")
+        self.active = item.get("lv_active") == "active"
+
+
+class VolumeGroup:
+    """ An LVM2 volume group, with its PVs and LVs """
+
+    name = None
+    uuid = None
+
+    # In bytes
+    size = 0
+    free = 0
+
+    pvs = None
+    lvs = None
+
+    def __init__(self, item):
+        self.name = item.get("vg_name")
+        self.uuid = item.get("vg_uuid")
+        self.size = get_report_int(item, "vg_size")
+        self.free = get_report_int(item, "vg_free")
+        self.pvs = []
+        self.lvs = []
+
+    def is_within(self, disk):
+        """ Determine if every PV of this group lives on the given disk """
+        disk = os.path.basename(os.path.realpath(disk))
+        for pv in self.pvs:
+            name = os.path.basename(os.path.realpath(pv.path or ""))
+            if disk not in get_backing_devices(name):
+                return False
+        return True
+
+
+class LvmReport:
+    """ Everything LVM2 knows about, from a single fullreport """
+
+    # Mapping of name -> VolumeGroup
+    vgs = None
+
+    # Mapping of device node -> PhysicalVolume, orphans included
+    pvs = None
+
+    def __init__(self):
+        self.vgs = OrderedDict()
+        self.pvs = OrderedDict()
+
+    def load(self, data):
+        """ Fill in from the parsed JSON of lvm fullreport. Each report
+            covers a single VG, or the orphan PVs """
+        for report in data.get("report", []):
+            vg = None
+            for item in report.get("vg", []):
+                # Orphans come under a nameless group
+                if item.get("vg_name"):
+                    vg = VolumeGroup(item)
+                    self.vgs[vg.name] = vg
+            vg_name = vg.name if vg else None
+            for item in report.get("pv", []):
+                pv = PhysicalVolume(item, vg_name)
+                self.pvs[pv.path] = pv
+                if vg:
+                    vg.pvs.append(pv)
+            for item in report.get("lv", []):
+                if not vg:
+                    continue
+                vg.lvs.append(LogicalVolume(item, vg_name))
+
+    def get_vg(self, name):
+        return self.vgs.get(name)
+
+    def get_pv(self, path):
+        return self.pvs.get(path)
+
+    def get_free_vg_name(self, base, drive_path=None):
+        """ A volume group name that won't clash with any group outside of
+            drive_path, whose groups are about to be destroyed anyway """
+        taken = set()
+        for vg in self.vgs.values():
+            if drive_path and vg.is_within(drive_path):
+                continue
+            taken.add(vg.name)
+        name = base
+        index = 1
+        while name in taken:
+            index += 1
+            name = "{}{}".format(base, index)
+        return name
+
+
+def get_lvm_report():
+    """ Run lvm fullreport once, returning an LvmReport, or None if LVM2
+        isn't usable here """
+    cmd = [LVM_BINARY, "fullreport", "--reportformat", "json",
+           "--units", "b", "--nosuffix"]
+    try:
+        out = subprocess.check_output(cmd)
+        data = json.loads(out)
+    except Exception as e:
+        print("Failed to execute {}: {}".format(" ".join(cmd), e))
+        return None
+    report = LvmReport()
+    report.load(data)
+    return report
@@ -86,6 +86,9 @@ class InstallInfo:
     bootloader_sz = None
     bootloader_install = False
 
+    # Read every installed file back and check it against the source
+    verify_copy = False
+
     invalidated = False
 
     def __init__(self):
@@ -107,6 +110,9 @@ class MainWindow(Gtk.ApplicationWindow):
     pages = list()
     page_index = 0
 
+    # Page currently shown, told when we move away from it
+    current_page = None
+
     info = None
 
     disk_manager = None
@@ -252,7 +258,7 @@ class MainWindow(Gtk.ApplicationWindow):
 
         # Shared helpers
         self.perms = PermissionsManager()
-        self.disk_manager = DiskManager()
+        self.disk_manager = DiskManager(self.perms)
 
         self.update_current_page()
         self.show_all()
@@ -322,6 +328,9 @@ class MainWindow(Gtk.ApplicationWindow):
 
     def update_current_page(self):
         page = self.pages[self.page_index]
+        if self.current_page and self.current_page is not page:
+            self.current_page.leave()
+        self.current_page = page
         self.set_final_step(False)
 
         if self.page_index == len(self.pages) - 1:
@@ -0,0 +1,126 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from . import SOURCE_DIGESTS
+from .blockdev import SYSFS_BLOCK, get_queue_device, get_node_size
+import os
+
+MKFS_EXT4 = "mkfs.ext4"
+
+# Largest block size ext4 can mount on a 4KiB page system
+EXT4_MAX_BLOCK_SIZE = 4096
+
+# mke2fs.conf gives a default filesystem one inode per 16KiB. We'll only
+# ever hand out fewer, and never fewer than one per 64KiB
+DEFAULT_INODE_RATIO = 16 * 1024
+MAX_INODE_RATIO = 64 * 1024
+
+# Inodes to leave room for, per file in the install payload, to cover its
+# directories and links, updates, and whatever the user brings along
+PAYLOAD_INODE_HEADROOM = 16
+
+
+def get_payload_files(source=None, digests=SOURCE_DIGESTS):
+    """ Number of files in the install payload, or None if we don't know.
+
+        A digest list shipped alongside the image has the exact count, but
+        few images carry one, so otherwise it's the inodes in use on the
+        mounted source filesystem """
+    try:
+        with open(digests, "r") as inp:
+            return sum(1 for line in inp if line.strip())
+    except IOError:
+        pass
+    if not source:
+        return None
+    try:
+        vfs = os.statvfs(source)
+    except OSError as e:
+        print("Cannot count payload files: {}".format(e))
+        return None
+    # Some filesystems, squashfs among them, don't count inodes at all
+    used = vfs.f_files - vfs.f_ffree
+    if used <= 0:
+        return None
+    return used
+
+
+class FormatProfile:
+    """ mkfs options suited to whatever a node actually lives on.
+
+        Rotational disks get lazy inode table and journal init, so that a
+        multi-TB format doesn't sit there zeroing, and solid state disks
+        are discarded up front, which is free and leaves lazy init safe.
+        Block size follows the physical sector so small filesystems don't
+        end up doing read-modify-write, and a root filesystem's inode
+        count is sized from the payload rather than its sheer size. """
+
+    path = None
+
+    # Size in bytes of the node itself
+    size = 0
+
+    rotational = True
+    discard = False
+    physical_block_size = 0
+
+    def __init__(self, path, root=SYSFS_BLOCK):
+        self.path = path
+        self.size = get_node_size(path, root)
+        device = get_queue_device(path, root)
+        if not device:
+            return
+        self.rotational = device.rotational
+        self.discard = device.discard and device.is_ssd()
+        self.physical_block_size = device.physical_block_size
+
+    def get_inode_ratio(self, payload_files):
+        """ Bytes per inode to ask for given the number of files we're
+            about to install, or None to leave it to mke2fs """
+        if not payload_files or not self.size:
+            return None
+        ratio = DEFAULT_INODE_RATIO
+        while ratio < MAX_INODE_RATIO and \
+                self.size // (ratio * 2) >= \
+                payload_files * PAYLOAD_INODE_HEADROOM:
+            ratio *= 2
+        if ratio == DEFAULT_INODE_RATIO:
+            return None
+        return ratio
+
+    def get_ext4_options(self, payload_files=None):
+        """ Return the list of mkfs.ext4 options for this node """
+        opts = ["-F"]
+
+        if self.physical_block_size > 512:
+            opts.extend(["-b", str(min(self.physical_block_size,
+                                       EXT4_MAX_BLOCK_SIZE))])
+
+        ratio = self.get_inode_ratio(payload_files)
+        if ratio:
+            opts.extend(["-i", str(ratio)])
+
+        if self.discard:
+            extended = ["discard"]
+        else:
+            # Nothing to gain asking, and some devices are slow to refuse
+            extended = ["nodiscard"]
+        if self.rotational or not self.discard:
+            extended.extend(["lazy_itable_init=1", "lazy_journal_init=1"])
+        opts.extend(["-E", ",".join(extended)])
+        return opts
+
+    def get_ext4_command(self, payload_files=None):
+        """ Full mkfs.ext4 command line for this node """
+        opts = self.get_ext4_options(payload_files)
+        return "{} {} {}".format(MKFS_EXT4, " ".join(opts), self.path)
@@ -0,0 +1,390 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from .blockdev import get_backing_devices, get_devno_name
+from .syscalls import umount2, MNT_DETACH, UMOUNT_NOFOLLOW
+from collections import OrderedDict
+import errno
+import os
+import re
+import select
+import threading
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# Octal escapes used for whitespace and backslashes in mountinfo paths
+RE_MOUNT_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def unescape_mount_path(path):
+    """ Undo the kernel's escaping of a mountinfo path """
+    return RE_MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), path)
+
+
+def is_path_under(path, parent):
+    """ Determine if path is parent, or lives somewhere beneath it """
+    if path == parent:
+        return True
+    return path.startswith(parent.rstrip("/") + "/")
+
+
+class MountEntry:
+    """ A single line of mountinfo """
+
+    mount_id = None
+    parent_id = None
+
+    # major:minor of the mounted filesystem
+    device = None
+
+    # Path within the filesystem that is mounted, i.e. / unless this is
+    # a bind mount of a subdirectory
+    root = None
+    mount_point = None
+    options = None
+
+    fstype = None
+    source = None
+
+    def __init__(self, line):
+        fields = line.split()
+        # Optional fields run up to the lone separator
+        sep = fields.index("-", 6)
+        self.mount_id = int(fields[0])
+        self.parent_id = int(fields[1])
+        self.device = fields[2]
+        self.root = unescape_mount_path(fields[3])
+        self.mount_point = unescape_mount_path(fields[4])
+        self.options = fields[5]
+        self.fstype = fields[sep + 1]
+        self.source = unescape_mount_path(fields[sep + 2])
+
+
+def parse_mountinfo(text):
+    """ Return a list of MountEntry, in the kernel's order """
+    ret = []
+    for line in text.split("\n"):
+        if not line.strip():
+            continue
+        try:
+            ret.append(MountEntry(line))
+        except (ValueError, IndexError):
+            print("Ignoring malformed mountinfo: {}".format(line))
+    return ret
+
+
+class MountTable:
+    """ Snapshot of the mount tree, indexed every way we look it up """
+
+    # Mapping of mount id -> MountEntry, in mount order
+    entries = None
+
+    # Mapping of mount id -> list of child MountEntry, in mount order
+    children = None
+
+    # Mapping of mount point -> the MountEntry on top there
+    by_mount_point = None
+
+    # Mapping of major:minor -> list of MountEntry
+    by_devno = None
+
+    # Mapping of device node, i.e. /dev/sda1 -> list of MountEntry mounted
+    # from it, and the same for every device it lives on, i.e. /dev/sda
+    by_source = None
+    by_disk = None
+
+    # Device nodes holding the running system or the live media, along with
+    # every device they live on
+    system_devices = None
+
+    # Mapping of device node -> mount point, as get_mount_points returns
+    mount_points = None
+
+    def __init__(self, entries):
+        self.entries = OrderedDict()
+        self.children = dict()
+        self.by_mount_point = dict()
+        self.by_devno = dict()
+        self.by_source = dict()
+        self.by_disk = dict()
+        self.system_devices = set()
+        self.mount_points = dict()
+
+        # Each device is resolved through sysfs just the once
+        names = dict()
+        for entry in entries:
+            self.entries[entry.mount_id] = entry
+            self.children.setdefault(entry.parent_id, []).append(entry)
+            self.by_mount_point[entry.mount_point] = entry
+            self.by_devno.setdefault(entry.device, []).append(entry)
+
+            # Only interested in block devices
+            if not entry.source.startswith("/"):
+                continue
+            if entry.device not in names:
+                names[entry.device] = self.get_device_name(entry)
+            name = names[entry.device]
+            if not name:
+                continue
+            node = "/dev/{}".format(name)
+            self.by_source.setdefault(node, []).append(entry)
+            self.mount_points[node] = entry.mount_point
+
+            system = is_system_mount(entry.mount_point)
+            for disk in get_backing_devices(name):
+                disk = "/dev/{}".format(disk)
+                self.by_disk.setdefault(disk, []).append(entry)
+                if system:
+                    self.system_devices.add(disk)
+
+    def get_device_name(self, entry):
+        """ Name of the block device behind an entry, or None. Filesystems
+            spanning devices, i.e. btrfs, report an anonymous major 0 """
+        if not entry.device.startswith("0:"):
+            name = get_devno_name(entry.device)
+            if name:
+                return name
+        if not os.path.exists(entry.source):
+            return None
+        return os.path.basename(os.path.realpath(entry.source))
+
+    def get_subtree(self, path):
+        """ Every mount at or beneath path, children ahead of their parents
+            so they can be unmounted in order """
+        inside = OrderedDict()
+        for entry in self.entries.values():
+            if is_path_under(entry.mount_point, path):
+                inside[entry.mount_id] = entry
+
+        ret = []
+
+        def visit(entry):
+            for child in self.children.get(entry.mount_id, []):
+                if child.mount_id in inside:
+                    visit(child)
+            ret.append(entry)
+
+        for entry in inside.values():
+            if entry.parent_id not in inside:
+                visit(entry)
+        return ret
+
+    def get_mount_points_of(self, source):
+        """ Every place the given device is mounted """
+        return [x.mount_point for x in self.by_source.get(
+                get_device_node(source), [])]
+
+    def get_disk_mount_points(self, path):
+        """ Every place the given disk, or anything on it, is mounted """
+        return [x.mount_point for x in self.by_disk.get(
+                get_device_node(path), [])]
+
+    def is_system_device(self, path):
+        """ Determine if the given device, or anything on it, holds the
+            running system or the live media """
+        return get_device_node(path) in self.system_devices
+
+    def is_mount_point(self, path):
+        return path in self.by_mount_point
+
+
+def get_device_node(path):
+    """ Canonical node for a device, i.e. /dev/dm-0 for /dev/mapper/root """
+    return "/dev/{}".format(os.path.basename(os.path.realpath(path)))
+
+
+def is_system_mount(mount_point):
+    """ Determine if a mount point belongs to the running system, which is
+        to say the root filesystem or the live media beneath it """
+    return mount_point == "/" or is_path_under(mount_point, "/run/initramfs")
+
+
+def get_tree_roots(paths):
+    """ Those of paths which aren't beneath any of the others, in their
+        original order """
+    return [p for p in paths
+            if not any(q != p and is_path_under(p, q) for q in paths)]
+
+
+def read_link(path):
+    """ readlink that returns None on failure """
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+
+def find_mount_holders(mount_point, proc="/proc", sysfs="/sys/block"):
+    """ Describe everything keeping a mount busy: processes with open
+        files, working directories or mappings inside it, and loop devices
+        backed by files within it """
+    ret = []
+    try:
+        pids = [x for x in os.listdir(proc) if x.isdigit()]
+    except OSError:
+        pids = []
+    for pid in pids:
+        base = os.path.join(proc, pid)
+        paths = set()
+        for name in ["cwd", "root", "exe"]:
+            paths.add(read_link(os.path.join(base, name)))
+        try:
+            fds = os.listdir(os.path.join(base, "fd"))
+        except OSError:
+            fds = []
+        for fd in fds:
+            paths.add(read_link(os.path.join(base, "fd", fd)))
+        try:
+            with open(os.path.join(base, "maps"), "r") as maps:
+                for line in maps:
+                    fields = line.split(None, 5)
+                    if len(fields) == 6:
+                        paths.add(fields[5].strip())
+        except IOError:
+            pass
+        held = sorted(x for x in paths
+                      if x and is_path_under(x, mount_point))
+        if not held:
+            continue
+        try:
+            with open(os.path.join(base, "comm"), "r") as inp:
+                comm = inp.read().strip()
+        except IOError:
+            comm = "?"
+        ret.append("pid {} ({}) holds {}".format(pid, comm, held[0]))
+
+    try:
+        loops = [x for x in os.listdir(sysfs) if x.startswith("loop")]
+    except OSError:
+        loops = []
+    for loop in sorted(loops):
+        try:
+            with open(os.path.join(sysfs, loop, "loop/backing_file")) as inp:
+                backing = inp.read().strip()
+        except IOError:
+            continue
+        if is_path_under(backing, mount_point):
+            ret.append("/dev/{} is backed by {}".format(loop, backing))
+    return ret
+
+
+class MountManager:
+    """ Tear down mounts by following the kernel's mount table.
+
+        Unmounting a path takes down everything mounted beneath it too,
+        deepest first. There's no sleeping and retrying: a mount that is
+        busy doesn't change the mount table, so there is nothing to wait
+        on. Instead we name whatever is holding it and detach it lazily
+        straight away, leaving the kernel to finish once it's let go.
+        The shared MountTable is only reread when poll() on mountinfo
+        says the mounts have changed. """
+
+    path = None
+
+    # The latest MountTable, and the open mountinfo it was read through,
+    # which poll() tells us has changed since
+    table = None
+    watch = None
+    lock = None
+
+    def __init__(self, path=MOUNTINFO_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def read_table(self):
+        """ Return a MountTable of the current mounts """
+        with open(self.path, "r") as inp:
+            return MountTable(parse_mountinfo(inp.read()))
+
+    def get_table(self):
+        """ Return the current MountTable, shared by everyone until the
+            kernel reports the mounts have changed. Never modify it """
+        with self.lock:
+            if self.table and not self.wait_for_change(self.watch, 0):
+                return self.table
+            if self.watch:
+                self.watch.close()
+            # Open before reading, so poll() reports any change since
+            self.watch = open(self.path, "r")
+            self.table = MountTable(parse_mountinfo(self.watch.read()))
+            return self.table
+
+    def wait_for_change(self, watch, timeout):
+        """ Wait until the mount table changes from what was read through
+            the open mountinfo file watch, or timeout seconds pass """
+        poller = select.poll()
+        poller.register(watch.fileno(), select.POLLPRI | select.POLLERR)
+        try:
+            return len(poller.poll(int(timeout * 1000))) > 0
+        except select.error:
+            return False
+
+    def get_targets(self, table, thing):
+        """ Resolve a mount point or device to the mount points to take
+            down """
+        path = os.path.realpath(thing)
+        if table.is_mount_point(path):
+            return [path]
+        return table.get_mount_points_of(path)
+
+    def unmount_entries(self, entries):
+        """ Unmount each of entries in turn. Returns (progress, busy),
+            busy being the first entry we couldn't unmount for being in use,
+            or None if every unmount succeeded or failed for good """
+        progress = False
+        for entry in entries:
+            try:
+                umount2(entry.mount_point, UMOUNT_NOFOLLOW)
+                progress = True
+            except OSError as e:
+                if e.errno == errno.EBUSY:
+                    return (progress, entry)
+                # Already gone from under us
+                if e.errno in [errno.EINVAL, errno.ENOENT]:
+                    continue
+                print("Failed to unmount {}: {}".format(
+                      entry.mount_point, e))
+                return (progress, None)
+        return (progress, None)
+
+    def unmount(self, thing):
+        """ Unmount the given mount point or device, and everything mounted
+            beneath it. Returns False if anything remains mounted """
+        while True:
+            table = self.read_table()
+            entries = []
+            for target in self.get_targets(table, thing):
+                entries.extend(table.get_subtree(target))
+            if not entries:
+                return True
+            progress, busy = self.unmount_entries(entries)
+            if busy is not None:
+                break
+            if not progress:
+                return False
+
+        holders = find_mount_holders(busy.mount_point)
+        if not holders:
+            holders = ["nothing we can see"]
+        print("{} is busy: {}".format(busy.mount_point, "; ".join(holders)))
+
+        # Detach the whole subtree in one go, the kernel finishes the job
+        # once the holders let go
+        for target in get_tree_roots([x.mount_point for x in entries]):
+            try:
+                umount2(target, MNT_DETACH | UMOUNT_NOFOLLOW)
+            except OSError as e:
+                if e.errno not in [errno.EINVAL, errno.ENOENT]:
+                    print("Failed to detach {}: {}".format(target, e))
+                    return False
+        return True
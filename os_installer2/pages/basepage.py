@@ -50,6 +50,10 @@ class BasePage(Gtk.Box):
     def prepare(self, info):
         pass
 
+    def leave(self):
+        """ Called on moving away from this page """
+        pass
+
     def seed(self, setup):
         pass
 
@@ -13,9 +13,10 @@
 
 from .basepage import BasePage
 from gi.repository import Gdk, Gtk, GLib
+from os_installer2.blockdev import BlockInventory
 from os_installer2.diskman import DriveProber
+from os_installer2.hotplug import HotplugMonitor
 from os_installer2.strategy import DiskStrategyManager
-import threading
 
 
 class BrokenWindowsPage(Gtk.Box):
@@ -56,25 +57,32 @@ class BrokenWindowsPage(Gtk.Box):
     def on_clicked(self, btn, w=None):
         """ Update owner page """
         self.owner.can_continue = True
-        self.owner.info.owner.set_can_next(True)
+        self.owner.update_can_next()
         self.owner.stack.set_visible_child_name("chooser")
 
 
 class ChooserPage(Gtk.Box):
     """ Main chooser UI """
 
+    owner = None
     combo = None
     strategy_box = None
     respond = False
     manager = None
     drives = None
 
+    # Shown while the chosen strategy waits on exact minimum sizes
+    status = None
+    status_spinner = None
+    status_label = None
+
     # To record the strategy.
     info = None
 
-    def __init__(self):
+    def __init__(self, owner):
         Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL, spacing=0)
 
+        self.owner = owner
         self.set_property("orientation", Gtk.Orientation.VERTICAL)
         self.set_border_width(40)
 
@@ -87,17 +95,33 @@ class ChooserPage(Gtk.Box):
         self.strategy_box.set_margin_top(20)
         self.pack_start(self.strategy_box, True, True, 0)
 
+        self.status = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 0)
+        self.status_spinner = Gtk.Spinner()
+        self.status.pack_start(self.status_spinner, False, False, 10)
+        self.status_label = Gtk.Label("")
+        self.status.pack_start(self.status_label, False, False, 0)
+        self.status_spinner.show()
+        self.status_label.show()
+        self.status.set_no_show_all(True)
+        self.pack_end(self.status, False, False, 0)
+
         self.respond = True
         self.combo.connect("changed", self.on_combo_changed)
 
     def on_combo_changed(self, combo, w=None):
         if not self.respond:
             return
-        drive = self.drives[combo.get_active_id()]
+        self.show_strategies()
+
+    def show_strategies(self, keep=None):
+        """ List the strategies for the active drive, selecting the one
+            named keep if it's still possible, otherwise the first """
+        drive = self.drives[self.combo.get_active_id()]
         strats = self.manager.get_strategies(drive)
 
         self.reset_options()
         leader = None
+        chosen = None
         for strat in strats:
             # update it
             strat.update_operations(self.info.owner.get_disk_manager(),
@@ -107,13 +131,19 @@ class ChooserPage(Gtk.Box):
             button.strategy = strat
             if not leader:
                 leader = button
+            elif strat.get_name() == keep:
+                chosen = button
             button.get_child().set_use_markup(True)
             button.connect("toggled", self.on_radio_toggle)
             self.strategy_box.pack_start(button, False, False, 8)
             button.show_all()
         # Force selection
-        if leader:
+        if chosen:
+            chosen.set_active(True)
+        elif leader:
             self.on_radio_toggle(leader)
+        else:
+            self.update_status()
 
     def reset_options(self):
         """ Reset available strategies """
@@ -127,6 +157,47 @@ class ChooserPage(Gtk.Box):
         strat = radio.strategy
         self.info.strategy = strat
 
+        # Jump the queue for whatever we're now waiting on
+        sizer = self.info.owner.get_disk_manager().sizer
+        for part in strat.get_unresolved():
+            sizer.prioritise(part)
+        self.update_status()
+
+    def is_ready(self):
+        """ Whether the chosen strategy, if any, can go ahead """
+        if not self.info or not self.info.strategy:
+            return True
+        return self.info.strategy.is_ready()
+
+    def update_status(self):
+        """ Show what the chosen strategy is still waiting on """
+        pending = list()
+        if self.info and self.info.strategy:
+            pending = self.info.strategy.get_unresolved()
+        if pending:
+            self.status_label.set_markup(
+                "Checking how far {} can shrink".format(
+                    ", ".join(x.path for x in pending)) + u"…")
+            self.status_spinner.start()
+            self.status.show()
+        else:
+            self.status_spinner.stop()
+            self.status.hide()
+        self.owner.update_can_next()
+
+    def refresh_partition(self, part):
+        """ An exact minimum size came in, so offer the strategies again if
+            it's on the drive we're showing """
+        active_id = self.combo.get_active_id()
+        if not self.respond or not active_id:
+            return
+        if self.drives[active_id].partitions.get(part.path) is not part:
+            return
+        keep = None
+        if self.info.strategy:
+            keep = self.info.strategy.get_name()
+        self.show_strategies(keep)
+
     def reset(self):
         self.respond = False
         self.drives = dict()
@@ -149,6 +220,61 @@ class ChooserPage(Gtk.Box):
                 active_id = drive.path
         self.combo.set_active_id(active_id)
 
+    def find_drive_row(self, path):
+        """ Return the position of a drive within the combo, or -1 """
+        column = self.combo.get_id_column()
+        for index, row in enumerate(self.combo.get_model()):
+            if row[column] == path:
+                return index
+        return -1
+
+    def update_drive(self, prober, drive, index):
+        """ Show a newly attached drive at the given index, or refresh one
+            that we're already showing """
+        broken_uefi = self.manager.broken_uefi
+        self.manager = DiskStrategyManager(prober)
+        active_id = self.combo.get_active_id()
+
+        self.respond = False
+        position = self.find_drive_row(drive.path)
+        if position >= 0:
+            self.combo.remove(position)
+        self.combo.insert(index, drive.path, drive.get_display_string())
+        self.drives[drive.path] = drive
+        if not active_id:
+            active_id = drive.path
+        self.combo.set_active_id(active_id)
+        self.respond = True
+
+        # Leave the user's choice alone unless it's no longer valid
+        if active_id == drive.path or \
+                broken_uefi != self.manager.broken_uefi:
+            self.on_combo_changed(self.combo)
+
+    def remove_drive(self, prober, path):
+        """ Stop showing a drive that has gone away """
+        position = self.find_drive_row(path)
+        if position < 0:
+            return
+        broken_uefi = self.manager.broken_uefi
+        self.manager = DiskStrategyManager(prober)
+        was_active = self.combo.get_active_id() == path
+
+        self.respond = False
+        self.combo.remove(position)
+        self.drives.pop(path, None)
+        if was_active:
+            self.info.strategy = None
+            self.reset_options()
+            self.combo.set_active(0)
+        self.respond = True
+
+        if not self.combo.get_active_id():
+            self.update_status()
+            return
+        if was_active or broken_uefi != self.manager.broken_uefi:
+            self.on_combo_changed(self.combo)
+
 
 class WhoopsPage(Gtk.Box):
     """ No disks on this system """
@@ -208,9 +334,23 @@ class InstallerDiskLocationPage(BasePage):
     prober = None
     can_continue = False
 
+    # Disks coming and going while we're visible are probed one at a time
+    # on the disk manager's PrivilegedWorker, as is the full probe. Those
+    # arriving during the full probe wait in pending until it has finished
+    hotplug = None
+    watching = False
+    loading = False
+    pending = None
+
+    # Exact minimum sizes came in while we weren't looking
+    sizes_stale = False
+
     def __init__(self):
         BasePage.__init__(self)
 
+        self.hotplug = HotplugMonitor(self.on_hotplug_event)
+        self.pending = list()
+
         self.stack = Gtk.Stack()
         self.pack_start(self.stack, True, True, 0)
 
@@ -221,7 +361,7 @@ class InstallerDiskLocationPage(BasePage):
         broken = BrokenWindowsPage(self)
         self.stack.add_named(broken, "broken-windows")
         self.stack.add_named(self.spinner, "loading")
-        self.chooser = ChooserPage()
+        self.chooser = ChooserPage(self)
         self.stack.add_named(self.chooser, "chooser")
 
         self.stack.set_visible_child_name("loading")
@@ -244,13 +384,10 @@ class InstallerDiskLocationPage(BasePage):
         """ Load the disks within a thread """
         # Scan parts
         dm = self.info.owner.get_disk_manager()
-        perms = self.info.owner.get_perms_manager()
 
-        perms.up_permissions()
         self.prober = DriveProber(dm)
         self.info.prober = self.prober
         self.prober.probe()
-        perms.down_permissions()
 
         # Currently the only GTK call here
         Gdk.threads_enter()
@@ -273,10 +410,24 @@ class InstallerDiskLocationPage(BasePage):
 
         if can_continue:
             GLib.idle_add(self.update_disks)
+        GLib.idle_add(self.finish_loading)
 
     def update_disks(self):
         """ Thread load finished, update UI from discovered info """
         self.chooser.set_drives(self.info, self.prober)
+        self.update_windows_present()
+
+        # Allow forward navigation now
+        self.update_can_next()
+        return False
+
+    def update_can_next(self):
+        """ Only go forward once a strategy is chosen and ready """
+        self.info.owner.set_can_next(self.can_continue and
+                                     self.chooser.is_ready())
+
+    def update_windows_present(self):
+        """ Record whether any drive holds Windows """
         self.info.windows_present = False
         for drive in self.prober.drives:
             for os in drive.operating_systems:
@@ -285,17 +436,146 @@ class InstallerDiskLocationPage(BasePage):
                     self.info.windows_present = True
                     break
 
-        # Allow forward navigation now
-        self.info.owner.set_can_next(self.can_continue)
+    def finish_loading(self):
+        """ Full probe is done, catch up on anything plugged in meanwhile """
+        self.loading = False
+        pending = self.pending
+        self.pending = list()
+        for action, path in pending:
+            self.on_hotplug(action, path)
+        return False
+
+    def on_hotplug_event(self, action, path):
+        """ Hand events from the monitor thread over to the main thread """
+        GLib.idle_add(self.on_hotplug, action, path)
+
+    def on_hotplug(self, action, path):
+        """ A disk was attached or detached """
+        if self.loading:
+            self.pending.append((action, path))
+            return False
+        if not self.prober or not self.get_mapped():
+            # We'll look at everything again when they come back
+            self.info.invalidated = True
+            return False
+        self.run_disk_job(self.probe_hotplug, self.prober, action, path)
+        return False
+
+    def on_min_size_event(self, part):
+        """ Hand resolved sizes from the privileged worker over to the main
+            thread """
+        GLib.idle_add(self.on_min_size, part)
+
+    def on_min_size(self, part):
+        """ A partition's exact minimum size is known """
+        if not self.watching:
+            self.sizes_stale = True
+            return False
+        self.chooser.refresh_partition(part)
+        return False
+
+    def run_disk_job(self, func, *args):
+        """ Queue func(*args) to run with privileges """
+        worker = self.info.owner.get_disk_manager().worker
+        worker.submit(func, args)
+
+    def probe_hotplug(self, prober, action, path):
+        """ Probe a single hotplugged disk, on the privileged worker """
+        if not self.watching:
+            # We've moved on since, leave the disks be
+            return
+        drive = None
+        try:
+            if action == "add":
+                drive = prober.probe_device(path)
+            else:
+                prober.forget_device(path)
+        except Exception as e:
+            print("Failed to probe {}: {}".format(path, e))
+        GLib.idle_add(self.apply_hotplug, prober, path, drive)
+
+    def resume_hotplug(self):
+        """ Listen again on coming back to the page, catching up on disks
+            that came and went while we were away """
+        self.watching = True
+        self.hotplug.start()
+        if not self.prober or self.loading:
+            return
+        if self.sizes_stale and \
+                self.stack.get_visible_child_name() == "chooser":
+            self.sizes_stale = False
+            keep = None
+            if self.info.strategy:
+                keep = self.info.strategy.get_name()
+            self.chooser.show_strategies(keep)
+        known = self.info.owner.get_disk_manager().inventory.devices
+        current = BlockInventory()
+        current.scan()
+        for path in list(known):
+            if path not in current.devices:
+                self.on_hotplug("remove", path)
+        for path, device in current.devices.items():
+            old = known.get(path)
+            if old and old.size == device.size and old.model == device.model:
+                continue
+            self.on_hotplug("add", path)
+
+    def leave(self):
+        """ Stop watching disks, so nothing changes behind later pages """
+        self.watching = False
+        self.hotplug.stop()
+
+    def apply_hotplug(self, prober, path, drive):
+        """ Update the prober and UI for a single attached or detached
+            disk. drive is None if the disk is gone or unusable """
+        if prober is not self.prober:
+            # Since superseded by a full probe
+            return False
+        if not self.get_mapped():
+            self.info.invalidated = True
+            return False
+
+        if drive:
+            index = self.prober.add_drive(drive)
+        elif not self.prober.remove_drive(path):
+            return False
+
+        if len(self.prober.drives) == 0:
+            self.info.strategy = None
+            self.stack.set_visible_child_name("whoops")
+            self.can_continue = False
+        elif self.stack.get_visible_child_name() == "whoops":
+            # First usable disk, set everything up as a full probe would
+            if self.prober.is_broken_windows_uefi():
+                self.stack.set_visible_child_name("broken-windows")
+                self.can_continue = False
+            else:
+                self.stack.set_visible_child_name("chooser")
+                self.can_continue = True
+            self.chooser.set_drives(self.info, self.prober)
+        else:
+            if drive:
+                self.chooser.update_drive(self.prober, drive, index)
+            else:
+                self.chooser.remove_drive(self.prober, path)
+            if self.stack.get_visible_child_name() == "broken-windows" \
+                    and not self.prober.is_broken_windows_uefi():
+                self.stack.set_visible_child_name("chooser")
+                self.can_continue = True
+
+        self.update_windows_present()
+        self.update_can_next()
         return False
 
     def init_view(self):
         """ Prepare for viewing... """
         if self.had_init and not self.info.invalidated:
+            self.resume_hotplug()
             return
         self.info.invalidated = False
         self.can_continue = False
         self.had_init = True
+        self.sizes_stale = False
         self.stack.set_visible_child_name("loading")
         self.spinner.start()
         self.spinner.show_all()
@@ -306,12 +586,17 @@ class InstallerDiskLocationPage(BasePage):
         self.info.owner.set_can_previous(False)
         self.queue_draw()
 
-        t = threading.Thread(target=self.load_disks)
-        t.daemon = True
-        t.start()
+        # Listen first, so nothing slips by between probing and listening
+        self.loading = True
+        self.watching = True
+        self.hotplug.start()
+        dm = self.info.owner.get_disk_manager()
+        dm.sizer.set_callback(self.on_min_size_event)
+
+        self.run_disk_job(self.load_disks)
         return False
 
     def prepare(self, info):
         self.info = info
         self.init_view()
-        self.info.owner.set_can_next(self.can_continue)
+        self.update_can_next()
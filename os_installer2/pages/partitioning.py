@@ -513,6 +513,7 @@ class DualBootPage(Gtk.Box):
         self.image.set_pixel_size(64)
         self.label.set_markup("<big>{}</big>".format(os.name))
 
+        # Resolved before the disk page let us through
         used = info.strategy.candidate_part.min_size
         avail = info.strategy.candidate_part.size
 
@@ -16,14 +16,22 @@ from gi.repository import Gtk, GLib, Pango
 import threading
 import time
 from collections import OrderedDict
-from os_installer2 import SOURCE_FILESYSTEM, INNER_FILESYSTEM
+from os_installer2 import SOURCE_FILESYSTEM, INNER_FILESYSTEM, SOURCE_DIGESTS
+from os_installer2 import format_size_local
+from os_installer2.copier import CopyManifest, CopyVerifier
+from os_installer2.copier import ImageStreamer, SystemCopier
+from os_installer2.devwait import wait_for_nodes
 from os_installer2.diskops import DiskOpCreateDisk, DiskOpResizeOS
 from os_installer2.diskops import DiskOpCreatePartition
 from os_installer2.diskops import DiskOpCreateESP
 from os_installer2.diskops import DiskOpCreateLogicalVolume
+from os_installer2.diskops import DiskOpCreateLUKSPhysicalVolume
 from os_installer2.diskops import DiskOpCreateVolumeGroup
 from os_installer2.diskops import DiskOpFormatRootLate
 from os_installer2.diskops import DiskOpFormatSwapLate
+from os_installer2.journal import InstallJournal, get_plan_fingerprint
+from os_installer2.mkfs import get_payload_files
+from os_installer2.mounts import get_tree_roots
 from os_installer2.postinstall import PostInstallVfs
 from os_installer2.postinstall import PostInstallRemoveLiveConfig
 from os_installer2.postinstall import PostInstallSyncFilesystems
@@ -38,7 +46,6 @@ from os_installer2.postinstall import PostInstallFstab
 from os_installer2.postinstall import PostInstallUsysconf
 from os_installer2.postinstall import PostInstallBootloader
 import os
-import stat
 import parted
 import sys
 import shutil
@@ -64,10 +71,10 @@ class InstallerProgressPage(BasePage):
     # Current string for the idle monitor to display in Gtk thread
     display_string = None
 
-    # How much we need to copy
+    # How much we need to copy, and how far along we are
     filesystem_source_size = 0
-    filesystem_copied_size = 0
     filesystem_copying = False
+    copy_progress = None
     past_simulation = False
 
     # Enabled post-install steps
@@ -84,6 +91,9 @@ class InstallerProgressPage(BasePage):
 
     error_msgs = None
 
+    # Record of completed stages, so a failed attempt can be resumed
+    journal = None
+
     def set_error_message(self, error_msg):
         """ Set the error message, i.e. something Super Bad happened """
         if not error_msg:
@@ -161,11 +171,45 @@ class InstallerProgressPage(BasePage):
         if not self.filesystem_copying:
             print(sz)
 
+    def format_eta(self, seconds):
+        """ Rough human readable time remaining """
+        if seconds < 60:
+            return "less than a minute remaining"
+        minutes = int(round(seconds / 60.0))
+        if minutes == 1:
+            return "about a minute remaining"
+        return "about {} minutes remaining".format(minutes)
+
+    def get_copy_display_string(self):
+        """ Describe the copy progress, only ever formatted from the UI """
+        progress = self.copy_progress
+        progress.sample()
+        done = progress.get_bytes()
+        tot = self.filesystem_source_size
+        sz = "{}: {} of {}".format(progress.phase,
+                                   format_size_local(done),
+                                   format_size_local(tot))
+        if progress.byte_rate is not None:
+            sz += " at {}/s, {} files/s".format(
+                format_size_local(progress.byte_rate),
+                int(progress.file_rate))
+            eta = progress.get_eta(tot)
+            if eta is not None:
+                sz += ", {}".format(self.format_eta(eta))
+        current = progress.get_current()
+        if current:
+            sz += "\n<small>/{}</small>".format(
+                GLib.markup_escape_text(current))
+        return sz
+
     def idle_monitor(self):
         """ Called periodicially so we can update our view """
-        self.label.set_markup(self.get_display_string())
-        if self.filesystem_copying:
-            cp = float(self.filesystem_copied_size)
+        if self.filesystem_copying and self.copy_progress:
+            self.label.set_markup(self.get_copy_display_string())
+        else:
+            self.label.set_markup(self.get_display_string())
+        if self.filesystem_copying and self.copy_progress:
+            cp = float(self.copy_progress.get_bytes())
             tot = float(self.filesystem_source_size)
             if cp < tot and cp > 0:
                 fraction = cp / tot
@@ -197,18 +241,44 @@ class InstallerProgressPage(BasePage):
             msg = "Installation has failed, and changes were made to disk\n" \
                   "The installer will now exit."
 
+        can_resume = self.past_simulation and self.journal and \
+            len(self.journal.steps) > 0
+        if can_resume:
+            msg = "Installation has failed, and changes were made to disk\n" \
+                  "Retrying will resume from the last completed step."
+
         msg += "\n\n{}\n".format("\n".join(
             [str(x) for x in self.error_msgs]))
         d = Gtk.MessageDialog(parent=self.info.owner,
                               flags=Gtk.DialogFlags.MODAL,
                               type=Gtk.MessageType.ERROR,
-                              buttons=Gtk.ButtonsType.OK,
+                              buttons=Gtk.ButtonsType.NONE,
                               message_format=msg)
+        if can_resume:
+            d.add_button("Quit", Gtk.ResponseType.CLOSE)
+            d.add_button("Retry", Gtk.ResponseType.OK)
+        else:
+            d.add_button("OK", Gtk.ResponseType.CLOSE)
 
-        d.run()
+        r = d.run()
         d.destroy()
+        if can_resume and r == Gtk.ResponseType.OK:
+            self.reset_install()
+            self.begin_install()
+            return
         sys.exit(0)
 
+    def reset_install(self):
+        """ Clear out the remains of a failed attempt so we can go again """
+        self.error_msgs = []
+        self.mount_tracker.clear()
+        self.temp_dirs = []
+        self.post_installs = []
+        self.post_install_current = 0
+        self.copy_progress = None
+        self.filesystem_copying = False
+        self.progressbar.set_fraction(0.0)
+
     def finish_installer(self):
         """ Wrap things out and decide on the final call. """
         if len(self.error_msgs) > 0:
@@ -310,10 +380,14 @@ class InstallerProgressPage(BasePage):
 
         self.set_display_string("Unmounting filesystems - might take a while")
 
-        # Visit in reverse order
+        # Visit in reverse order. Taking down each tree from its root takes
+        # everything mounted beneath it, vfs binds included, in one go
         keys = self.mount_tracker.keys()
         keys.reverse()
+        roots = get_tree_roots([self.mount_tracker[x] for x in keys])
         for key in keys:
+            if self.mount_tracker[key] not in roots:
+                continue
             if not self.dm.do_umount(self.mount_tracker[key]):
                 self.set_error_message("Cannot umount {}".format(key))
                 ret = False
@@ -327,32 +401,6 @@ class InstallerProgressPage(BasePage):
                 ret = False
         return ret
 
-    def do_copy_file(self, source, dest):
-        """ Simply copy a file .. """
-        input = None
-        dst = None
-
-        try:
-            BUF_SIZE = 16 * 1024
-            input = open(source, "rb")
-            dst = open(dest, "wb")
-            while (True):
-                read = input.read(BUF_SIZE)
-                if not read:
-                    break
-                self.filesystem_copied_size += len(read)
-                dst.write(read)
-            input.close()
-            dst.close()
-            return True
-        except Exception as ex:
-            self.set_error_message(ex)
-            if input:
-                input.close()
-            if dst:
-                dst.close()
-        return False
-
     def get_installer_target_filesystem(self):
         """ Get the mount point for the root partition for post-install """
         root = self.info.strategy.get_root_partition()
@@ -366,8 +414,6 @@ class InstallerProgressPage(BasePage):
 
     def copy_system(self):
         """ Attempt to copy the entire filesystem across """
-        print("Need to copy {} bytes".format(self.filesystem_source_size))
-
         source_fs = self.get_mount_point_for(INNER_FILESYSTEM)
         if not source_fs:
             return False
@@ -377,130 +423,86 @@ class InstallerProgressPage(BasePage):
             self.set_error_message("Missing rootfs")
             return False
 
-        self.filesystem_copying = True
+        # Take stock of exactly what we're going to copy
+        self.set_display_string("Scanning source filesystem")
+        manifest = CopyManifest(source_fs,
+                                self.info.strategy.get_copy_excludes())
+        try:
+            manifest.scan()
+        except Exception as e:
+            self.set_error_message("Cannot scan source: {}".format(e))
+            return False
+        self.filesystem_source_size = manifest.total_size
+        print("Need to copy {} bytes".format(self.filesystem_source_size))
 
-        # Ensure we don't follow links, i.e. we're never in a situation where
-        # we're creating broken leading directories
-        for root, dirs, files in os.walk(source_fs,
-                                         topdown=False,
-                                         followlinks=False):
-            # Mend the root to allow source/target use
-            dir_root = root
-            if dir_root.startswith(source_fs):
-                dir_root = dir_root[len(source_fs):]
-                if len(dir_root) > 0 and dir_root[0] != '/':
-                    dir_root = "/" + dir_root
-
-            # Do we skip this guy? Don't traverse what we don't need
-            dir_base = dir_root.split("/")[0]
-            if dir_base in ["home", "lost+found", "boot"]:
-                continue
+        verifier = None
+        if self.info.verify_copy:
+            verifier = CopyVerifier(source_fs, root_fs)
+        # Spares hashing the source, where the media lists its digests
+        if verifier and os.path.exists(SOURCE_DIGESTS):
+            try:
+                verifier.load_digests(SOURCE_DIGESTS)
+            except Exception as e:
+                self.set_error_message("Cannot load digests: {}".format(e))
+                return False
 
-            # Create the container directory first
-            target_dir = os.path.join(root_fs, dir_root[1:])
-            if not os.path.exists(target_dir):
-                try:
-                    # We set the permissions up properly later
-                    os.makedirs(target_dir, 0o0755)
-                except Exception as ex:
-                    self.set_error_message("Cannot create dir: {}".format(ex))
-                    return False
-
-            # Walk the tree from the back to restore permissions properly
-            for f in files:
-                source_path = os.path.join(source_fs, dir_root[1:], f)
-                target_path = os.path.join(root_fs, dir_root[1:], f)
-
-                # Not really necessary but meh
-                self.set_display_string("Copying {}".format(
-                    os.path.join(dir_root, f)))
-
-                try:
-                    st = os.lstat(source_path)
-                    mode = stat.S_IMODE(st.st_mode)
-                    is_link = False
-                    is_copied = False
-
-                    if stat.S_ISLNK(st.st_mode):
-                        linkto = os.readlink(source_path)
-                        os.symlink(linkto, target_path)
-                        is_link = True
-                    elif stat.S_ISCHR(st.st_mode):
-                        os.mknod(target_path, stat.S_IFCHR | mode, st.st_rdev)
-                    elif stat.S_ISBLK(st.st_mode):
-                        os.mknod(target_path, stat.S_IFBLK | mode, st.st_rdev)
-                    elif stat.S_ISFIFO(st.st_mode):
-                        os.mknod(target_path, stat.S_IFIFO | mode)
-                    elif stat.S_ISSOCK(st.st_mode):
-                        os.mknod(target_path, stat.S_IFSOCK | mode)
-                    elif stat.S_ISREG(st.st_mode):
-                        is_copied = True
-                        if not self.do_copy_file(source_path, target_path):
-                            return False
-
-                    # Chown it.
-                    os.lchown(target_path, st.st_uid, st.st_gid)
-                    if not is_link:
-                        # Copy permissiions/utime
-                        os.chmod(target_path, mode)
-                        os.utime(target_path, (st.st_atime, st.st_mtime))
-                    # copy_file handles size
-                    if not is_copied:
-                        self.filesystem_copied_size += st.st_size
-
-                except Exception as ex:
-                    self.set_error_message("Failed to copy {}".format(
-                        source_path))
-                    return False
-
-            # Chown/utime the dirs as we come out, meaning we set perms/time
-            # on everything but / itself
-            for d in dirs:
-                try:
-                    target_path = os.path.join(root_fs, dir_root[1:], d)
-                    source_path = os.path.join(source_fs, dir_root[1:], d)
-                    self.set_display_string("Creating: {}".format(
-                        os.path.join(dir_root, d)))
-                    st = os.lstat(source_path)
-                    mode = stat.S_IMODE(st.st_mode)
-                    if not stat.S_ISDIR(st.st_mode):
-                        linkto = os.readlink(source_path)
-                        os.symlink(linkto, target_path)
-                        os.lchown(target_path, st.st_uid, st.st_gid)
-                        continue
+        # Whatever an interrupted attempt got onto the disk stays put
+        resume = self.journal.is_done("copying")
+        self.journal.mark("copying")
+        copier = SystemCopier(manifest, root_fs, verifier=verifier,
+                              resume=resume)
+        self.copy_progress = copier.progress
+        self.filesystem_copying = True
+        started = time.time()
+        if not copier.copy():
+            self.set_error_message(copier.get_errors())
+            return False
 
-                    os.chown(target_path, st.st_uid, st.st_gid)
-                    os.chmod(target_path, mode)
-                    os.utime(target_path, (st.st_atime, st.st_mtime))
-                    # Update progress
-                    self.filesystem_copied_size += st.st_size
-                except Exception as ex:
-                    self.set_error_message("Permissions issue: {} {}".format(
-                        ex, d))
-                    return False
+        # Worth having in the logs when comparing machines
+        elapsed = max(time.time() - started, 0.001)
+        copied = copier.progress.get_bytes()
+        print("Copied {} bytes, {} entries in {:.1f}s ({}/s)".format(
+            copied, copier.progress.get_files(), elapsed,
+            format_size_local(copied / elapsed)))
 
         self.set_display_string("Finalizing file copy")
+        self.journal.mark("copy")
         return True
 
-    def wait_disk(self, op):
-        """ Wait for the disk to become available """
-        if isinstance(op, DiskOpCreateLogicalVolume):
-            p = op.part
-        elif isinstance(op, DiskOpCreateVolumeGroup):
-            p = op.path
-        else:
-            p = op.part.path
-
-        self.set_display_string("Verifying existence of {}".format(p))
-        count = 0
-        while (count < 5):
-            if os.path.exists(p):
-                return True
-            self.set_display_string("Waiting for {}".format(p))
-            time.sleep(0.5)
-            count += 1
-        if not os.path.exists(p):
-            self.set_error_message("Couldn't locate {}".format(p))
+    def get_image_streamer(self):
+        """ Return an ImageStreamer if the image can go straight to root """
+        if not self.info.strategy.can_stream_image():
+            return None
+        source = self.get_mount_point_for(SOURCE_FILESYSTEM)
+        root = self.info.strategy.get_root_partition()
+        if not source or not root:
+            return None
+        streamer = ImageStreamer(os.path.join(source, INNER_FILESYSTEM), root)
+        if not streamer.is_possible():
+            return None
+        return streamer
+
+    def stream_system(self, streamer):
+        """ Write the source image onto the (unmounted) root partition """
+        self.set_display_string(streamer.describe())
+        if not streamer.stream():
+            self.set_error_message(streamer.get_errors())
+            return False
+        self.journal.mark("stream")
+        return True
+
+    def wait_disks(self, ops):
+        """ Wait for the nodes of every partition in ops to show up, with
+            one timeout for the lot """
+        paths = [op.part.path for op in ops
+                 if isinstance(op, DiskOpCreatePartition) and op.part]
+        if not paths:
+            return True
+        self.set_display_string("Waiting for {}".format(", ".join(paths)))
+        missing = wait_for_nodes(paths)
+        if missing:
+            self.set_error_message("Couldn't locate {}".format(
+                ", ".join(missing)))
             return False
         return True
 
@@ -529,7 +531,8 @@ class InstallerProgressPage(BasePage):
             disk = disk.duplicate()
 
         part_offset = 0
-        part_step = parted.sizeToSectors(1, 'MiB', strategy.device.sectorSize)
+        part_step = parted.sizeToSectors(strategy.drive.get_alignment(), 'B',
+                                         strategy.device.sectorSize)
         if disk:
             # Start at the very beginning of the disk, we don't
             # support free-space installation
@@ -570,36 +573,120 @@ class InstallerProgressPage(BasePage):
         except:
             pass
 
+        self.journal.record_operations(ops, disk)
+        self.journal.mark("partition")
+        return self.format_disk_strategy(disk)
+
+    def format_disk_strategy(self, disk):
+        """ Format everything the strategy created, skipping whatever an
+            earlier attempt already got done.
+
+            Operations only wait on those they depend on, such as an LVM
+            volume on its group, so independent partitions are formatted
+            concurrently. """
+        ops = self.info.strategy.get_operations()
+
         # Post-process, format all the things
         post_types = [
             DiskOpCreatePartition,
+            DiskOpCreateLUKSPhysicalVolume,
             DiskOpCreateLogicalVolume,
             DiskOpCreateVolumeGroup,
             DiskOpFormatRootLate,
             DiskOpFormatSwapLate,
         ]
 
-        for op in ops:
-            is_type = False
-            for t in post_types:
-                if isinstance(op, t):
-                    is_type = True
-                    break
-            if not is_type:
+        # Mapping of op index -> indices of the post ops it waits on
+        pending = OrderedDict()
+        for index, op in enumerate(ops):
+            if not any(isinstance(op, t) for t in post_types):
                 continue
-            # Wait for device to show up!
-            if isinstance(op, DiskOpCreatePartition):
-                if not self.wait_disk(op):
-                    return False
-
-            p = op.describe()
-            self.set_display_string("Applying operation: {}".format(p))
-            if not op.apply_format(disk):
-                e = op.get_errors()
+            deps = [i for i in pending if op.depends_on(ops[i])]
+            pending[index] = deps
+
+        done = set(i for i in pending
+                   if self.journal.is_done("format:{}".format(i)))
+        for index in done:
+            del pending[index]
+
+        # Wait for the device nodes up front, all at once
+        if not self.wait_disks([ops[i] for i in pending]):
+            return False
+
+        cond = threading.Condition()
+        running = dict()
+        failed = []
+
+        def format_one(index, op):
+            """ Worker thread for a single operation """
+            ok = False
+            try:
+                if op.formats_root and self.get_image_streamer():
+                    # The image brings its own filesystem along
+                    print("Leaving {} for the image".format(op.describe()))
+                    ok = True
+                else:
+                    ok = op.apply_format(disk)
+                if not ok:
+                    e = op.get_errors()
+                    self.set_error_message(
+                        "Failed to apply format: {}".format(e))
+                    print(op.describe())
+            except Exception as e:
                 self.set_error_message("Failed to apply format: {}".format(e))
-                print(op.describe())
-                return False
+            with cond:
+                running[index] = ok
+                cond.notify()
+
+        with cond:
+            while True:
+                # Start everything whose dependencies are satisfied, unless
+                # we're only waiting out what's left after a failure
+                for index in list(pending):
+                    if failed:
+                        break
+                    if not all(x in done for x in pending[index]):
+                        continue
+                    del pending[index]
+                    op = ops[index]
+                    self.set_display_string("Applying operation: {}".format(
+                        op.describe()))
+                    running[index] = None
+                    thr = threading.Thread(target=format_one,
+                                           args=(index, op))
+                    thr.daemon = True
+                    thr.start()
+
+                if not running:
+                    break
+                cond.wait()
 
+                for index, ok in list(running.items()):
+                    if ok is None:
+                        continue
+                    del running[index]
+                    if not ok:
+                        failed.append(index)
+                        continue
+                    done.add(index)
+                    self.journal.record_operations(ops)
+                    self.journal.mark("format:{}".format(index))
+
+        return not failed and not pending
+
+    def release_target_disk(self):
+        """ Unmount anything on the target disk, such as partitions the
+            desktop helpfully automounted, before we start rewriting it """
+        path = self.info.strategy.drive.path
+        table = self.dm.mounts.get_table()
+        if table.is_system_device(path):
+            self.set_error_message("{} holds the running system".format(path))
+            return False
+        for mpoint in get_tree_roots(table.get_disk_mount_points(path)):
+            print("DEBUG: Unmounting {} from {}".format(mpoint, path))
+            if not self.dm.do_umount(mpoint):
+                self.set_error_message("Cannot umount {}".format(mpoint))
+                return False
         return True
 
     def mount_target_filesystem(self):
@@ -668,33 +755,86 @@ class InstallerProgressPage(BasePage):
         print("DEBUG: /boot ({}) mounted at {}".format(boot, target))
         return True
 
+    def load_journal(self):
+        """ Pick up the journal of an earlier attempt at this very plan,
+            provided the disk is still as that attempt left it """
+        strategy = self.info.strategy
+        plan = get_plan_fingerprint(strategy)
+        self.journal = InstallJournal()
+        if not self.journal.load(plan):
+            return
+        if not self.journal.is_done("partition"):
+            return
+        ops = strategy.get_operations()
+        if not self.journal.restore_operations(ops, strategy.device):
+            print("Disk has changed since the last attempt, starting over")
+            self.journal.reset(plan)
+
     def install_thread(self):
         """ Handle the real work of installing =) """
         self.set_display_string("Analyzing installation configuration")
 
+        # Leave the disks and privileges to us from here on, once any
+        # probe still in flight is done
+        self.dm.worker.stop()
+
         # immediately gain privs
         self.info.owner.get_perms_manager().up_permissions()
 
-        # Simulate!
-        self.set_display_string("Simulating disk operations")
-        print("SIMULATING")
-        if not self.apply_disk_strategy(True):
+        self.load_journal()
+        if not self.release_target_disk():
             self.installing = False
-            self.set_error_message("Failed to simulate disk strategy")
             return False
 
-        self.past_simulation = True
-        print("NO LONGER SIMULATING")
-        # Now do it for real.
-        if not self.apply_disk_strategy(False):
+        # Mount the source first, so formatting knows whether root will be
+        # written from the image instead
+        if not self.mount_source_filesystem():
+            self.unmount_all()
+            self.set_error_message("Failed to mount!")
             self.installing = False
-            self.set_error_message("Failed to apply disk strategy")
             return False
 
-        # Now mount up as it were.
-        if not self.mount_source_filesystem():
+        # Root gets its inodes sized from what we're about to put on it
+        payload = get_payload_files(self.get_installer_source_filesystem())
+        for op in self.info.strategy.get_operations():
+            if op.formats_root:
+                op.payload_files = payload
+
+        if self.journal.is_done("partition"):
+            # Partitions are in place, just finish formatting them
+            self.past_simulation = True
+            self.set_display_string("Resuming installation")
+            if not self.format_disk_strategy(self.info.strategy.disk):
+                self.unmount_all()
+                self.installing = False
+                self.set_error_message("Failed to apply disk strategy")
+                return False
+        else:
+            # Simulate!
+            self.set_display_string("Simulating disk operations")
+            print("SIMULATING")
+            if not self.apply_disk_strategy(True):
+                self.unmount_all()
+                self.installing = False
+                self.set_error_message("Failed to simulate disk strategy")
+                return False
+
+            self.past_simulation = True
+            print("NO LONGER SIMULATING")
+            # Now do it for real.
+            if not self.apply_disk_strategy(False):
+                self.unmount_all()
+                self.installing = False
+                self.set_error_message("Failed to apply disk strategy")
+                return False
+
+        # Write the image out wholesale when possible, saving the file copy
+        streamer = self.get_image_streamer()
+        if streamer and self.journal.is_done("stream"):
+            print("Image already written, skipping")
+        elif streamer and not self.stream_system(streamer):
             self.unmount_all()
-            self.set_error_message("Failed to mount!")
+            self.set_error_message("Failed to write system image!")
             self.installing = False
             return False
 
@@ -704,6 +844,16 @@ class InstallerProgressPage(BasePage):
             self.set_error_message("Failed to mount target!")
             self.installing = False
             return False
+        self.journal.set_mirror(self.get_installer_target_filesystem())
+
+        # The image came with everything, drop what a copy would skip
+        if streamer and not streamer.prune(
+                self.get_installer_target_filesystem(),
+                self.info.strategy.get_copy_excludes()):
+            self.set_error_message(streamer.get_errors())
+            self.unmount_all()
+            self.installing = False
+            return False
 
         # If we have a /boot, mount it here
         if not self.maybe_mount_boot():
@@ -726,8 +876,9 @@ class InstallerProgressPage(BasePage):
                 self.installing = False
                 return False
 
-        # Copy source -> target
-        if not self.copy_system():
+        # Copy source -> target, unless that's already been done
+        copied = streamer or self.journal.is_done("copy")
+        if not copied and not self.copy_system():
             self.filesystem_copying = False
             self.unmount_all()
             self.installing = False
@@ -757,6 +908,10 @@ class InstallerProgressPage(BasePage):
         # Now run the post-installs
         self.in_postinstall = True
         for step in self.post_installs:
+            checkpoint = "post:{}".format(step.__class__.__name__)
+            if step.is_checkpoint() and self.journal.is_done(checkpoint):
+                self.post_install_current += 1
+                continue
             self.should_pulse = step.is_long_step()
             disp = step.get_display_string()
             self.set_display_string(disp)
@@ -774,10 +929,13 @@ class InstallerProgressPage(BasePage):
                 self.unmount_all()
                 self.installing = False
                 return False
+            if step.is_checkpoint():
+                self.journal.mark(checkpoint)
             self.post_install_current += 1
 
         # Actually made it. :o
         self.in_postinstall = False
+        self.journal.discard()
 
         # Ensure the idle monitor stops
         if not self.unmount_all():
@@ -13,6 +13,8 @@
 
 from .basepage import BasePage
 from gi.repository import Gtk
+from os_installer2 import SOURCE_DIGESTS
+import os
 import re
 
 # This is all we allow. OK.
@@ -28,6 +30,7 @@ class InstallerSystemPage(BasePage):
     error_label = None
     check_boot = None
     combo_boot = None
+    check_verify = None
     # Bootloader issues
     error_label2 = None
     respond = True
@@ -76,6 +79,15 @@ class InstallerSystemPage(BasePage):
         self.pack_start(boot, False, False, 0)
         wid_group.add_widget(self.combo_boot)
 
+        # Cheap enough to default to when the media lists its digests
+        self.check_verify = Gtk.CheckButton.new_with_label(
+            "Check every installed file once copied (slower)")
+        self.check_verify.set_active(os.path.exists(SOURCE_DIGESTS))
+        self.check_verify.connect("toggled", self.on_verify_toggled)
+        self.check_verify.set_halign(Gtk.Align.CENTER)
+        self.check_verify.set_margin_top(10)
+        self.pack_start(self.check_verify, False, False, 0)
+
         self.error_label = Gtk.Label.new("")
         self.error_label.set_valign(Gtk.Align.START)
         self.pack_end(self.error_label, False, False, 0)
@@ -91,6 +103,10 @@ class InstallerSystemPage(BasePage):
         self.combo_boot.set_sensitive(w.get_active())
         self.info.bootloader_install = w.get_active()
 
+    def on_verify_toggled(self, w, d=None):
+        """ Handle copy verification """
+        self.info.verify_copy = w.get_active()
+
     def on_combo_changed(self, combo, w=None):
         """ Combo updated """
         if not self.respond:
@@ -152,6 +168,7 @@ class InstallerSystemPage(BasePage):
 
     def prepare(self, info):
         self.info = info
+        self.info.verify_copy = self.check_verify.get_active()
         dm = self.info.owner.get_disk_manager()
         if dm.is_efi_booted():
             self.info.bootloader_install = True
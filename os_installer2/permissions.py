@@ -11,8 +11,16 @@
 #  (at your option) any later version.
 #
 
+import itertools
 import os
 import pwd
+import Queue
+import threading
+
+# Order in which queued PrivilegedWorker jobs run
+PRIORITY_STOP = 0
+PRIORITY_URGENT = 1
+PRIORITY_BACKGROUND = 2
 
 
 class PermissionsManager:
@@ -70,3 +78,118 @@ class PermissionsManager:
             print("Failed to raise permissions: {}".format(e))
             return False
         return True
+
+
+class PrivilegedJob:
+    """ A single call queued on the PrivilegedWorker """
+
+    func = None
+    args = None
+
+    # Set once the job has run, or been abandoned by a stopping worker
+    done = None
+    ran = False
+
+    result = None
+    error = None
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+
+
+class PrivilegedWorker:
+    """ The one thread that raises and drops our privileges.
+
+        PermissionsManager switches the whole process at once, so two
+        threads each raising and dropping them would pull root out from
+        under one another. Everything needing root while the installer is
+        still interactive queues up here and runs in turn, urgent jobs
+        ahead of background ones. """
+
+    perms = None
+    queue = None
+    thread = None
+    lock = None
+
+    # Keeps jobs of equal priority in the order they came
+    counter = None
+
+    # Once stopped, whoever stopped us holds the privileges
+    stopped = False
+
+    def __init__(self, perms):
+        self.perms = perms
+        self.queue = Queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def put(self, priority, job):
+        """ Queue a job, starting the thread if need be. Returns False if
+            we've been stopped """
+        with self.lock:
+            if self.stopped:
+                return False
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.queue.put((priority, next(self.counter), job))
+        return True
+
+    def submit(self, func, args=(), background=False):
+        """ Queue func(*args) without waiting for it """
+        priority = PRIORITY_BACKGROUND if background else PRIORITY_URGENT
+        return self.put(priority, PrivilegedJob(func, args))
+
+    def call(self, func, *args):
+        """ Run func(*args) with privileges, waiting for the result """
+        if threading.current_thread() is self.thread:
+            return func(*args)
+        job = PrivilegedJob(func, args)
+        if self.put(PRIORITY_URGENT, job):
+            job.done.wait()
+        if not job.ran:
+            # Whoever stopped us is in charge of privileges now
+            return func(*args)
+        if job.error:
+            raise job.error
+        return job.result
+
+    def stop(self):
+        """ Wait for the current job, and drop everything still queued, so
+            the caller can take privileges over for good """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            thread = self.thread
+            self.queue.put((PRIORITY_STOP, next(self.counter), None))
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self):
+        """ Worker thread """
+        while True:
+            _, _, job = self.queue.get()
+            if job is None:
+                break
+            self.perms.up_permissions()
+            try:
+                job.result = job.func(*job.args)
+            except Exception as e:
+                print("Privileged job failed: {}".format(e))
+                job.error = e
+            self.perms.down_permissions()
+            job.ran = True
+            job.done.set()
+
+        # Nobody is going to run these now
+        while True:
+            try:
+                _, _, job = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job:
+                job.done.set()
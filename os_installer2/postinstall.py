@@ -85,6 +85,11 @@ class PostInstallStep:
             pulse, so the user doesn't believe the UI locked up """
         return False
 
+    def is_checkpoint(self):
+        """ Override to return False when this step only sets up state for
+            the current run, and must be repeated when resuming """
+        return True
+
 
 class PostInstallVfs(PostInstallStep):
     """ Set up the virtual filesystems required for all other steps """
@@ -104,6 +109,10 @@ class PostInstallVfs(PostInstallStep):
     def get_display_string(self):
         return "Setting up virtual filesystems"
 
+    def is_checkpoint(self):
+        """ Bind mounts don't outlive the run that made them """
+        return False
+
     def apply(self):
         target = self.installer.get_installer_target_filesystem()
         for source_point in self.vfs_points:
@@ -0,0 +1,150 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from .superblock import read_filesystem_info
+import json
+import os
+import threading
+
+# Lives as long as this boot of the live session, as do the write counters
+PROBE_CACHE_PATH = "/run/os-installer/probe-cache.json"
+
+# Bump whenever the cached state changes incompatibly
+PROBE_CACHE_VERSION = 2
+
+# Field of /sys/class/block/*/stat counting completed writes
+STAT_WRITES_COMPLETED = 4
+
+
+def get_write_count(path):
+    """ Number of writes completed to a block device since boot, or None """
+    node = os.path.basename(os.path.realpath(path))
+    fpath = "/sys/class/block/{}/stat".format(node)
+    try:
+        with open(fpath, "r") as inp:
+            return int(inp.read().split()[STAT_WRITES_COMPLETED])
+    except Exception:
+        return None
+
+
+def get_table_key(partition):
+    """ Describe the disk and partition table a partition lives on """
+    device = partition.disk.device
+    layout = [[p.geometry.start, p.geometry.length]
+              for p in partition.disk.partitions]
+    return [device.path, device.getLength(), device.sectorSize, layout,
+            partition.path, partition.geometry.start,
+            partition.geometry.length]
+
+
+class ProbeCache:
+    """ Remember the results of probing partitions across page visits and
+        installer restarts.
+
+        Each entry is keyed on the partition table it belongs to, the
+        identity and generation recorded in its superblock, and the kernel's
+        count of writes made to it, so any write since we probed it (even
+        one we can't see in the superblock) sends it back for probing. """
+
+    path = None
+
+    # Mapping of partition path -> (key, state)
+    entries = None
+    lock = None
+
+    # Held across a whole save, so writers can't trample one another's
+    # temporary file or rename an older snapshot over a newer one
+    save_lock = None
+
+    def __init__(self, path=PROBE_CACHE_PATH):
+        self.path = path
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def load(self):
+        """ Pick up the results of any earlier run during this boot """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as inp:
+                data = json.load(inp)
+            if data.get("version") != PROBE_CACHE_VERSION:
+                return
+            with self.lock:
+                self.entries.update(data["entries"])
+        except Exception as e:
+            print("Ignoring probe cache: {}".format(e))
+
+    def save(self):
+        """ Write the cache out for the next run """
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps({
+                    "version": PROBE_CACHE_VERSION,
+                    "entries": self.entries,
+                })
+            tmp = "{}.tmp".format(self.path)
+            try:
+                dirname = os.path.dirname(self.path)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname, 0o0755)
+                with open(tmp, "w") as out:
+                    out.write(data)
+                os.rename(tmp, self.path)
+            except Exception as e:
+                print("Cannot write probe cache: {}".format(e))
+
+    def get_key(self, path, table_key):
+        """ Build the complete key for a partition, reading its superblock
+            and write count. Returns None if it can't be identified """
+        writes = get_write_count(path)
+        if writes is None:
+            return None
+        try:
+            info = read_filesystem_info(path)
+        except Exception:
+            return None
+        if not info:
+            return None
+        return table_key + [writes, info.fstype, info.uuid, info.generation]
+
+    def lookup(self, path, key):
+        """ Return the cached state for a partition, or None if we don't
+            have any for this exact key """
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if not entry or entry[0] != key:
+            return None
+        return entry[1]
+
+    def store(self, path, key, state):
+        """ Remember the state for a partition under the given key """
+        if key is None:
+            return
+        # Round trip now, so lookups compare like with like
+        key = json.loads(json.dumps(key))
+        with self.lock:
+            self.entries[path] = [key, state]
+
+    def update_partition(self, path, state):
+        """ Refresh the partition state stored for a path, keeping its key.
+            Returns False if there was nothing stored for it """
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry or not entry[1]["partition"]:
+                return False
+            entry[1]["partition"] = state
+        return True
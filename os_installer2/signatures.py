@@ -0,0 +1,80 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import mmap
+import os
+import re
+
+
+def utf16_signature(text):
+    """ Signature for a string as Windows stores it, i.e. within BCD """
+    return text.encode("utf-16-le")
+
+
+class SignatureScanner:
+    """ Find which of many byte signatures occur within a file.
+
+        All signatures are compiled into a single pattern, so the file is
+        mapped once and walked once, however many signatures we look for,
+        stopping as soon as every one of them has turned up. """
+
+    # Values to report, in order of preference
+    values = None
+
+    # The combined pattern, one group per signature, and the mapping of
+    # each group number to its index within values
+    regex = None
+    group_index = None
+
+    def __init__(self, signatures):
+        """ signatures is a list of (value, bytes) in order of preference """
+        self.values = [value for value, sig in signatures]
+        # Longest first, so no signature hides one it prefixes
+        order = sorted(range(len(signatures)),
+                       key=lambda i: len(signatures[i][1]), reverse=True)
+        self.group_index = dict()
+        alternates = []
+        for group, index in enumerate(order):
+            self.group_index[group + 1] = index
+            alternates.append(b"(" + re.escape(signatures[index][1]) + b")")
+        self.regex = re.compile(b"|".join(alternates))
+
+    def scan_buffer(self, buf):
+        """ Return the values of all signatures within buf, in order of
+            preference """
+        found = set()
+        for m in self.regex.finditer(buf):
+            found.add(self.group_index[m.lastindex])
+            if len(found) == len(self.values):
+                break
+        return [self.values[x] for x in sorted(found)]
+
+    def scan(self, path):
+        """ Return the values of all signatures within the file at path, in
+            order of preference """
+        with open(path, "rb") as inp:
+            if os.fstat(inp.fileno()).st_size == 0:
+                return []
+            buf = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return self.scan_buffer(buf)
+            finally:
+                buf.close()
+
+    def match(self, path):
+        """ Return the most preferred signature value within the file at
+            path, or None if there are none """
+        found = self.scan(path)
+        if not found:
+            return None
+        return found[0]
@@ -32,6 +32,7 @@ from .diskops import DiskOpCreateLUKSPhysicalVolume
 from .diskops import DiskOpCreateLUKSContainer
 from .diskops import DiskOpCreateVolumeGroup
 from .diskops import DiskOpCreateLogicalVolume
+from .copier import load_copy_excludes
 from . import MIN_REQUIRED_SIZE, MB, GB
 
 
@@ -75,6 +76,17 @@ class DiskStrategy:
         print("FATAL: Unimplemented strategy!!")
         return None
 
+    def get_copy_excludes(self):
+        """ Globs, relative to the source root, of whatever the install
+            should leave off the target. Strategies may override this, and
+            the media may add its own via SOURCE_EXCLUDES """
+        return load_copy_excludes()
+
+    def can_stream_image(self):
+        """ Whether the root partition is ours to overwrite wholesale with
+            the live filesystem image, rather than copying file by file """
+        return False
+
     def __init__(self, dp, drive):
         self.drive = drive
         self.dp = dp
@@ -126,6 +138,15 @@ class DiskStrategy:
     def is_possible(self):
         return False
 
+    def get_unresolved(self):
+        """ Partitions whose exact minimum size we need before going ahead
+            with this strategy """
+        return []
+
+    def is_ready(self):
+        """ Whether we know all we need to go ahead with this strategy """
+        return not self.get_unresolved()
+
     def get_priority(self):
         return self.priority
 
@@ -231,6 +252,11 @@ class EmptyDiskStrategy(DiskStrategy):
                 continue
             return op.part.path
 
+    def can_stream_image(self):
+        """ Root is always freshly created, so it may take the image. With a
+            separate /boot the copy has to split the tree, so don't. """
+        return not self.requires_separate_boot()
+
     def requires_separate_boot(self):
         """ Determine if we need a separate boot partition too """
         if self.is_uefi():
@@ -310,8 +336,7 @@ class EmptyDiskStrategy(DiskStrategy):
                 op = DiskOpCreateBoot(self.drive.device, None, size_eat)
                 self.push_operation(op)
 
-            # NAUGHTY! Figure out a unique LVM2 ID
-            vg_name = "SolusSystem"
+            vg_name = self.dp.get_vg_name("SolusSystem", self.drive.path)
             if not self.use_encryption:
                 pv_op = DiskOpCreatePhysicalVolume(
                     self.drive.device, None, self.drive.size - size_eat)
@@ -532,9 +557,10 @@ class DualBootStrategy(DiskStrategy):
                 print("Warning: missing os_part: {}".format(os_part))
                 continue
             partition = self.drive.partitions[os_part]
+            # Until resolved this is only the estimate, which is never
+            # larger than the real minimum. We're asked again once it is
             if not partition.resizable:
                 continue
-            # Skip guys that are too small
             if partition.size - partition.min_size < MIN_REQUIRED_SIZE:
                 continue
             if partition.freespace < MIN_REQUIRED_SIZE:
@@ -552,8 +578,9 @@ class DualBootStrategy(DiskStrategy):
             fs = partition.partition.fileSystem
             if not fs:
                 continue
-            if fs.type == "ntfs" or fs.type.startswith("ext"):
-                self.potential_spots.append(partition)
+            if fs.type != "ntfs" and not fs.type.startswith("ext"):
+                continue
+            self.potential_spots.append(partition)
 
         self.potential_spots.sort(key=SystemPartition.getLength,
                                   reverse=True)
@@ -577,6 +604,12 @@ class DualBootStrategy(DiskStrategy):
                 return op.part.path
         return None
 
+    def get_unresolved(self):
+        """ We can't offer sizes until we know how far they can shrink """
+        if self.candidate_part.min_size_exact:
+            return []
+        return [self.candidate_part]
+
 
 class ReplaceOSStrategy(DiskStrategy):
     """ Replace the biggest OS with us """
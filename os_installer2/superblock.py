@@ -0,0 +1,232 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import binascii
+import struct
+
+# ext2/3/4, superblock at 1KiB
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_MAGIC = 0xEF53
+EXT_COMPAT_HAS_JOURNAL = 0x4
+EXT_INCOMPAT_RECOVER = 0x4
+EXT_INCOMPAT_EXTENTS = 0x40
+EXT_INCOMPAT_64BIT = 0x80
+EXT_INCOMPAT_FLEX_BG = 0x200
+
+# btrfs, primary superblock at 64KiB
+BTRFS_SUPERBLOCK_OFFSET = 64 * 1024
+BTRFS_MAGIC = b"_BHRfS_M"
+
+XFS_MAGIC = b"XFSB"
+NTFS_OEM_ID = b"NTFS    "
+
+FAT_BOOT_SIGNATURE = b"\x55\xaa"
+FAT_FSINFO_LEAD_SIG = 0x41615252
+FAT_FSINFO_STRUC_SIG = 0x61417272
+FAT_FREE_UNKNOWN = 0xFFFFFFFF
+
+# Enough to cover every superblock we understand
+READ_SIZE = BTRFS_SUPERBLOCK_OFFSET + 4096
+
+
+class FilesystemInfo:
+    """ What a filesystem says about itself, read without mounting it """
+
+    # i.e. ext4, ntfs, fat32, btrfs, xfs
+    fstype = None
+
+    label = None
+    uuid = None
+
+    # Sizes in bytes, free being what an unprivileged user may still use.
+    # Either may be None when the filesystem doesn't record it up front
+    size = None
+    free = None
+
+    # Set when the filesystem wasn't cleanly unmounted, meaning the
+    # figures above may be stale
+    dirty = False
+
+    # Opaque string that changes as the filesystem is mounted or written,
+    # None if the filesystem keeps no such record in its superblock
+    generation = None
+
+    def __init__(self, fstype):
+        self.fstype = fstype
+
+    def get_used(self):
+        """ Bytes in use, if known """
+        if self.size is None or self.free is None:
+            return None
+        return self.size - self.free
+
+    def is_ext(self):
+        return self.fstype in ["ext2", "ext3", "ext4"]
+
+
+def decode_label(raw):
+    """ Turn a NUL padded label into a string, or None if empty """
+    label = raw.split(b"\0")[0].strip()
+    if not label:
+        return None
+    return label.decode("utf-8", "replace")
+
+
+def format_uuid(raw):
+    """ Standard 8-4-4-4-12 representation of a 16 byte UUID """
+    h = binascii.hexlify(raw).decode("ascii")
+    return "{}-{}-{}-{}-{}".format(h[0:8], h[8:12], h[12:16], h[16:20],
+                                   h[20:32])
+
+
+def parse_ext(buf):
+    """ ext2/3/4 superblock, little endian """
+    sb = buf[EXT_SUPERBLOCK_OFFSET:EXT_SUPERBLOCK_OFFSET + 1024]
+    if len(sb) < 1024:
+        return None
+    if struct.unpack_from("<H", sb, 56)[0] != EXT_SUPERBLOCK_MAGIC:
+        return None
+
+    blocks, reserved, free = struct.unpack_from("<III", sb, 4)
+    log_block_size = struct.unpack_from("<I", sb, 24)[0]
+    mount_time, write_time = struct.unpack_from("<II", sb, 44)
+    compat, incompat = struct.unpack_from("<II", sb, 92)
+    if incompat & EXT_INCOMPAT_64BIT:
+        hi = struct.unpack_from("<III", sb, 0x150)
+        blocks |= hi[0] << 32
+        reserved |= hi[1] << 32
+        free |= hi[2] << 32
+
+    if incompat & (EXT_INCOMPAT_EXTENTS | EXT_INCOMPAT_64BIT |
+                   EXT_INCOMPAT_FLEX_BG):
+        info = FilesystemInfo("ext4")
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        info = FilesystemInfo("ext3")
+    else:
+        info = FilesystemInfo("ext2")
+
+    block_size = 1024 << log_block_size
+    info.size = blocks * block_size
+    info.free = max(free - reserved, 0) * block_size
+    info.uuid = format_uuid(sb[104:120])
+    info.label = decode_label(sb[120:136])
+    info.dirty = bool(incompat & EXT_INCOMPAT_RECOVER)
+    info.generation = "{}:{}:{}".format(mount_time, write_time, free)
+    return info
+
+
+def parse_btrfs(buf):
+    """ btrfs superblock, little endian """
+    sb = buf[BTRFS_SUPERBLOCK_OFFSET:BTRFS_SUPERBLOCK_OFFSET + 4096]
+    if len(sb) < 4096 or sb[0x40:0x48] != BTRFS_MAGIC:
+        return None
+    generation, = struct.unpack_from("<Q", sb, 0x48)
+    total, used = struct.unpack_from("<QQ", sb, 0x70)
+    info = FilesystemInfo("btrfs")
+    info.generation = str(generation)
+    info.size = total
+    info.free = max(total - used, 0)
+    info.uuid = format_uuid(sb[0x20:0x30])
+    info.label = decode_label(sb[0x12b:0x22b])
+    return info
+
+
+def parse_xfs(buf):
+    """ xfs superblock, big endian """
+    if buf[0:4] != XFS_MAGIC:
+        return None
+    block_size, blocks = struct.unpack_from(">IQ", buf, 4)
+    inodes, free_inodes, free_blocks = struct.unpack_from(">QQQ", buf, 128)
+    info = FilesystemInfo("xfs")
+    info.generation = "{}:{}:{}".format(inodes, free_inodes, free_blocks)
+    info.size = blocks * block_size
+    info.free = free_blocks * block_size
+    info.uuid = format_uuid(buf[32:48])
+    info.label = decode_label(buf[108:120])
+    return info
+
+
+def parse_ntfs(buf):
+    """ NTFS boot sector. Free space and the label live within the MFT,
+        so only the size is known up front """
+    if buf[3:11] != NTFS_OEM_ID:
+        return None
+    sector_size, = struct.unpack_from("<H", buf, 11)
+    sectors, = struct.unpack_from("<Q", buf, 40)
+    serial, = struct.unpack_from("<Q", buf, 72)
+    info = FilesystemInfo("ntfs")
+    info.size = sectors * sector_size
+    info.uuid = "{:016X}".format(serial)
+    return info
+
+
+def parse_fat(buf):
+    """ FAT12/16/32 boot sector. Only FAT32 tracks its free space, in the
+        FSInfo sector, and even that may be marked unknown """
+    if buf[510:512] != FAT_BOOT_SIGNATURE:
+        return None
+    if buf[82:87] == b"FAT32":
+        fstype = "fat32"
+        serial_off, label_off = 67, 71
+    elif buf[54:59] in [b"FAT12", b"FAT16"]:
+        fstype = buf[54:59].decode("ascii").lower()
+        serial_off, label_off = 39, 43
+    else:
+        return None
+
+    sector_size, cluster_sectors, reserved, num_fats, root_entries, \
+        total16, _, fat_size16 = struct.unpack_from("<HBHBHHBH", buf, 11)
+    if not sector_size or not cluster_sectors:
+        return None
+    total = total16 or struct.unpack_from("<I", buf, 32)[0]
+
+    info = FilesystemInfo(fstype)
+    info.size = total * sector_size
+    serial, = struct.unpack_from("<I", buf, serial_off)
+    info.uuid = "{:04X}-{:04X}".format(serial >> 16, serial & 0xFFFF)
+    label = decode_label(buf[label_off:label_off + 11])
+    if label and label != "NO NAME":
+        info.label = label
+
+    if fstype == "fat32":
+        fsinfo_sector, = struct.unpack_from("<H", buf, 48)
+        fsinfo = buf[fsinfo_sector * sector_size:][:512]
+        if len(fsinfo) == 512 and \
+                struct.unpack_from("<I", fsinfo, 0)[0] == \
+                FAT_FSINFO_LEAD_SIG and \
+                struct.unpack_from("<I", fsinfo, 484)[0] == \
+                FAT_FSINFO_STRUC_SIG:
+            free, = struct.unpack_from("<I", fsinfo, 488)
+            if free != FAT_FREE_UNKNOWN:
+                info.free = free * cluster_sectors * sector_size
+                info.generation = str(free)
+    return info
+
+
+# In order of checking, those with more specific magic first
+PARSERS = [parse_ext, parse_btrfs, parse_xfs, parse_ntfs, parse_fat]
+
+
+def read_filesystem_info(path):
+    """ Identify the filesystem on a device, returning a FilesystemInfo or
+        None if it is not one we understand """
+    with open(path, "rb") as inp:
+        buf = inp.read(READ_SIZE)
+    for parser in PARSERS:
+        try:
+            info = parser(buf)
+        except struct.error:
+            continue
+        if info:
+            return info
+    return None
@@ -0,0 +1,257 @@
+#!/bin/true
+# -*- coding: utf-8 -*-
+#
+#  This file is part of os-installer
+#
+#  Copyright 2013-2020 Solus <copyright@getsol.us>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+# Cached handle on the C library
+_libc = None
+
+# lseek whence values for sparse files, missing from Python 2's os module
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+NSEC_PER_SEC = 1000 * 1000 * 1000
+
+
+def get_libc():
+    """ Load the C library once, with errno support """
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library("c")
+        _libc = ctypes.CDLL(name, use_errno=True)
+    return _libc
+
+
+def _libc_func(name, restype, argtypes):
+    """ Look up a libc function, or None if this libc lacks it """
+    try:
+        func = getattr(get_libc(), name)
+    except AttributeError:
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+
+def _raise_errno(what):
+    """ Raise an OSError for the last failed libc call """
+    err = ctypes.get_errno()
+    raise OSError(err, "{}: {}".format(what, os.strerror(err)))
+
+
+def copy_file_range(fd_in, fd_out, count):
+    """ Copy up to count bytes between the current file offsets of two
+        descriptors inside the kernel. Returns the number of bytes copied.
+        Prefers the os module implementation when Python provides one """
+    if hasattr(os, "copy_file_range"):
+        return os.copy_file_range(fd_in, fd_out, count)
+
+    func = _libc_func("copy_file_range", ctypes.c_ssize_t,
+                      [ctypes.c_int, ctypes.c_void_p,
+                       ctypes.c_int, ctypes.c_void_p,
+                       ctypes.c_size_t, ctypes.c_uint])
+    if not func:
+        raise OSError(errno.ENOSYS, "copy_file_range: not supported by libc")
+    ret = func(fd_in, None, fd_out, None, count, 0)
+    if ret < 0:
+        _raise_errno("copy_file_range")
+    return ret
+
+
+def sendfile(fd_out, fd_in, count):
+    """ Transfer up to count bytes from the current offset of fd_in into
+        fd_out without a userspace buffer. Returns the bytes sent """
+    if hasattr(os, "sendfile"):
+        return os.sendfile(fd_out, fd_in, None, count)
+
+    func = _libc_func("sendfile", ctypes.c_ssize_t,
+                      [ctypes.c_int, ctypes.c_int,
+                       ctypes.c_void_p, ctypes.c_size_t])
+    if not func:
+        raise OSError(errno.ENOSYS, "sendfile: not supported by libc")
+    ret = func(fd_out, fd_in, None, count)
+    if ret < 0:
+        _raise_errno("sendfile")
+    return ret
+
+
+class Timespec(ctypes.Structure):
+    """ struct timespec """
+    _fields_ = [
+        ("tv_sec", ctypes.c_long),
+        ("tv_nsec", ctypes.c_long),
+    ]
+
+
+def futimens(fd, atime_ns, mtime_ns):
+    """ Set nanosecond access and modification times on an open fd """
+    if hasattr(os, "supports_fd") and os.utime in os.supports_fd:
+        os.utime(fd, ns=(atime_ns, mtime_ns))
+        return
+
+    func = _libc_func("futimens", ctypes.c_int,
+                      [ctypes.c_int, ctypes.POINTER(Timespec)])
+    if not func:
+        raise OSError(errno.ENOSYS, "futimens: not supported by libc")
+    times = (Timespec * 2)()
+    times[0].tv_sec, times[0].tv_nsec = divmod(atime_ns, NSEC_PER_SEC)
+    times[1].tv_sec, times[1].tv_nsec = divmod(mtime_ns, NSEC_PER_SEC)
+    if func(fd, times) != 0:
+        _raise_errno("futimens")
+
+
+def flistxattr(fd):
+    """ Return the names of all extended attributes on an open fd """
+    if hasattr(os, "listxattr"):
+        return os.listxattr(fd)
+
+    func = _libc_func("flistxattr", ctypes.c_ssize_t,
+                      [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t])
+    if not func:
+        raise OSError(errno.ENOSYS, "flistxattr: not supported by libc")
+    size = func(fd, None, 0)
+    if size < 0:
+        _raise_errno("flistxattr")
+    if size == 0:
+        return []
+    buf = ctypes.create_string_buffer(size)
+    size = func(fd, buf, size)
+    if size < 0:
+        _raise_errno("flistxattr")
+    return [x for x in buf.raw[:size].split(b"\0") if x]
+
+
+def fgetxattr(fd, name):
+    """ Return the value of a single extended attribute on an open fd """
+    if hasattr(os, "getxattr"):
+        return os.getxattr(fd, name)
+
+    func = _libc_func("fgetxattr", ctypes.c_ssize_t,
+                      [ctypes.c_int, ctypes.c_char_p,
+                       ctypes.c_void_p, ctypes.c_size_t])
+    if not func:
+        raise OSError(errno.ENOSYS, "fgetxattr: not supported by libc")
+    size = func(fd, name, None, 0)
+    if size < 0:
+        _raise_errno("fgetxattr")
+    buf = ctypes.create_string_buffer(max(size, 1))
+    size = func(fd, name, buf, size)
+    if size < 0:
+        _raise_errno("fgetxattr")
+    return buf.raw[:size]
+
+
+def fsetxattr(fd, name, value):
+    """ Set a single extended attribute on an open fd """
+    if hasattr(os, "setxattr"):
+        os.setxattr(fd, name, value)
+        return
+
+    func = _libc_func("fsetxattr", ctypes.c_int,
+                      [ctypes.c_int, ctypes.c_char_p,
+                       ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int])
+    if not func:
+        raise OSError(errno.ENOSYS, "fsetxattr: not supported by libc")
+    if func(fd, name, value, len(value), 0) != 0:
+        _raise_errno("fsetxattr")
+
+
+# posix_fadvise advice values
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+POSIX_FADV_NOREUSE = 5
+
+# sync_file_range flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+def posix_fadvise(fd, offset, length, advice):
+    """ Tell the kernel how we'll use a range of the file """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, advice)
+        return
+
+    func = _libc_func("posix_fadvise64", ctypes.c_int,
+                      [ctypes.c_int, ctypes.c_int64,
+                       ctypes.c_int64, ctypes.c_int])
+    if not func:
+        raise OSError(errno.ENOSYS, "posix_fadvise: not supported by libc")
+    # Returns the error rather than setting errno
+    ret = func(fd, offset, length, advice)
+    if ret != 0:
+        raise OSError(ret, "posix_fadvise: {}".format(os.strerror(ret)))
+
+
+def sync_file_range(fd, offset, length, flags):
+    """ Start and/or wait upon writeback of a range of the file """
+    func = _libc_func("sync_file_range", ctypes.c_int,
+                      [ctypes.c_int, ctypes.c_int64,
+                       ctypes.c_int64, ctypes.c_uint])
+    if not func:
+        raise OSError(errno.ENOSYS, "sync_file_range: not supported by libc")
+    if func(fd, offset, length, flags) != 0:
+        _raise_errno("sync_file_range")
+
+
+# umount2 flags
+MNT_DETACH = 2
+UMOUNT_NOFOLLOW = 8
+
+
+def umount2(target, flags=0):
+    """ Unmount the filesystem mounted at target """
+    func = _libc_func("umount2", ctypes.c_int,
+                      [ctypes.c_char_p, ctypes.c_int])
+    if not func:
+        raise OSError(errno.ENOSYS, "umount2: not supported by libc")
+    if not isinstance(target, bytes):
+        target = target.encode("utf-8")
+    if func(target, flags) != 0:
+        _raise_errno("umount2")
+
+
+# inotify flags and events
+IN_CLOEXEC = 0o2000000
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+
+def inotify_init1(flags=0):
+    """ Return a new inotify descriptor """
+    func = _libc_func("inotify_init1", ctypes.c_int, [ctypes.c_int])
+    if not func:
+        raise OSError(errno.ENOSYS, "inotify_init1: not supported by libc")
+    fd = func(flags)
+    if fd < 0:
+        _raise_errno("inotify_init1")
+    return fd
+
+
+def inotify_add_watch(fd, path, mask):
+    """ Watch path for the given events. Returns the watch descriptor """
+    func = _libc_func("inotify_add_watch", ctypes.c_int,
+                      [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32])
+    if not func:
+        raise OSError(errno.ENOSYS,
+                      "inotify_add_watch: not supported by libc")
+    if not isinstance(path, bytes):
+        path = path.encode("utf-8")
+    wd = func(fd, path, mask)
+    if wd < 0:
+        _raise_errno("inotify_add_watch")
+    return wd